@@ -0,0 +1,155 @@
+"""
+Streaming classification of many images with many models, used by the
+/api/classifications endpoint. A result is sent as an NDJSON line as soon
+as each (image, model) pair is classified. Each image is decoded once for
+all the models, and at most api_images_in_flight images are held in memory.
+The classifications go through the scheduler with the batch priority.
+With tiling, the images are classified by tiles (see app/ml/tiling.py).
+"""
+import asyncio
+import json
+
+from app.config import Configuration
+from app.executors import QueueFullError, inference_pool
+from app.scheduler import RequestShedError, scheduler
+from app.ml.classification_utils import (
+    catalog_image_digest, classify_decoded, classify_tiles, decode, decode_tiled, fetch_image, lookup_catalog_image,
+)
+from app.ml.result_cache import image_digest
+from app.forms.classification_form_upload import check_image_data
+
+conf = Configuration()
+
+
+async def _run(fn, *args):
+    """Runs fn in the inference pool. The batch API waits for room in the
+    pool instead of being shed like the interactive requests."""
+    while True:
+        try:
+            return await inference_pool.run(fn, *args)
+        except QueueFullError as e:
+            await asyncio.sleep(e.retry_after)
+
+
+async def _schedule(model_id, deadline, fn, *args):
+    """Runs fn with the batch priority, waiting while the batch queue is full."""
+    while True:
+        try:
+            return await scheduler.run(model_id, "batch", deadline, fn, *args)
+        except RequestShedError as e:
+            if e.reason != "queue_full":
+                raise
+            await asyncio.sleep(e.retry_after)
+        except QueueFullError as e:
+            await asyncio.sleep(e.retry_after)
+
+
+def _read_catalog_image(image_id, model_ids):
+    """Returns the digest of the image and the scores of the models
+    which are cached or precomputed."""
+    digest = catalog_image_digest(image_id)
+    known = {}
+    for model_id in model_ids:
+        output = lookup_catalog_image(model_id, image_id, digest)
+        if output is not None:
+            known[model_id] = output
+    return digest, known
+
+
+def _read_upload(upload):
+    """Reads and validates an uploaded image, with the checks of the upload
+    form. Returns its digest and the image with only its header parsed."""
+    upload.file.seek(0)
+    data = upload.file.read(conf.upload_max_bytes + 1)
+    upload.file.close()
+    errors, image = check_image_data(data)
+    if errors:
+        raise ValueError(" ".join(errors))
+    return image_digest(data), image
+
+
+def _line(image_id, model_id, **data):
+    return (json.dumps({"image_id": image_id, "model_id": model_id, **data}) + "\n").encode()
+
+
+async def _classify_source(source, model_ids, lines, timeout_s=None, tiling=None):
+    """Classifies one image, either a catalog image id or an UploadFile,
+    with all the models, putting the results in the lines queue. tiling is
+    the aggregation of the tiled classification, or None."""
+    try:
+        if isinstance(source, str):
+            image_id = source
+            # the precomputed scores are those of the central crop
+            digest, known = await _run(_read_catalog_image, image_id, [] if tiling else model_ids)
+            open_image = lambda: fetch_image(image_id)  # noqa: E731
+        else:
+            image_id = source.filename
+            digest, image = await _run(_read_upload, source)
+            known = {}
+            open_image = lambda: image  # noqa: E731
+        for model_id, output in known.items():
+            await lines.put(_line(image_id, model_id, classification_scores=output))
+        remaining = [m for m in model_ids if m not in known]
+        if not remaining:
+            return
+        img = await _run(lambda: (decode_tiled if tiling else decode)(open_image(), remaining))
+    except Exception as e:
+        for model_id in model_ids:
+            await lines.put(_line(image_id, model_id, error=str(e)))
+        return
+
+    deadline = scheduler.deadline("batch", timeout_s)
+
+    async def classify_one(model_id):
+        try:
+            if tiling:
+                scores = await _schedule(model_id, deadline, classify_tiles, model_id, img, digest, tiling)
+            else:
+                scores = await _schedule(model_id, deadline, classify_decoded, model_id, img, digest)
+            return model_id, {"classification_scores": scores}
+        except Exception as e:
+            return model_id, {"error": str(e)}
+
+    try:
+        for finished in asyncio.as_completed([classify_one(m) for m in remaining]):
+            model_id, data = await finished
+            await lines.put(_line(image_id, model_id, **data))
+    finally:
+        img.close()
+
+
+async def stream_classifications(sources, model_ids, timeout_s=None, tiling=None):
+    """Async generator of the NDJSON lines with the classification scores
+    of every source (catalog image id or UploadFile) for every model.
+    timeout_s bounds the time allowed to classify each image."""
+    lines = asyncio.Queue(maxsize=conf.api_images_in_flight * len(model_ids))
+    window = asyncio.Semaphore(conf.api_images_in_flight)
+    running = set()
+
+    async def classify_source(source):
+        try:
+            await _classify_source(source, model_ids, lines, timeout_s, tiling)
+        finally:
+            window.release()
+
+    async def produce():
+        for source in sources:
+            await window.acquire()
+            task = asyncio.create_task(classify_source(source))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        await asyncio.gather(*running)
+        await lines.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            line = await lines.get()
+            if line is None:
+                break
+            yield line
+    finally:
+        # the client went away: stop classifying
+        producer.cancel()
+        for task in list(running):
+            task.cancel()
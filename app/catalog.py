@@ -0,0 +1,66 @@
+"""
+In-memory catalog of the available images and of the Imagenet labels.
+The image folder is listed once and listed again only when its mtime
+changes (i.e. when files are added, removed or renamed), and the labels
+are parsed once and again only when their file changes.
+"""
+import bisect
+import json
+import os
+import threading
+
+
+class Catalog:
+    """
+    Sorted list of the images with the given extension in image_folder,
+    and labels of the classes read from labels_file.
+    """
+
+    def __init__(self, image_folder, labels_file, extension=".JPEG"):
+        self._image_folder = image_folder
+        self._labels_file = labels_file
+        self._extension = extension
+        self._images = []
+        self._images_mtime = None
+        self._labels = None
+        self._labels_mtime = None
+        self._lock = threading.Lock()
+
+    def images(self):
+        """Returns the sorted list of the image ids. The list is shared,
+        so it must not be modified."""
+        mtime = os.stat(self._image_folder).st_mtime_ns
+        if mtime != self._images_mtime:
+            with self._lock:
+                if mtime != self._images_mtime:
+                    with os.scandir(self._image_folder) as it:
+                        images = sorted(e.name for e in it if e.name.endswith(self._extension))
+                    self._images, self._images_mtime = images, mtime
+        return self._images
+
+    def search(self, prefix="", offset=0, limit=None):
+        """Returns the total number of images whose id starts with prefix
+        and the page of them starting at offset, of at most limit images."""
+        images = self.images()
+        start = bisect.bisect_left(images, prefix)
+        # the ids starting with prefix are sorted before prefix + the highest character
+        end = bisect.bisect_left(images, prefix + "\U0010ffff", lo=start) if prefix else len(images)
+        page_start = min(start + offset, end)
+        page_end = end if limit is None else min(page_start + limit, end)
+        return end - start, images[page_start:page_end]
+
+    def __contains__(self, image_id):
+        images = self.images()
+        i = bisect.bisect_left(images, image_id)
+        return i < len(images) and images[i] == image_id
+
+    def labels(self):
+        """Returns the labels of the classes as a list, where the index of
+        the list corresponds to the output class."""
+        mtime = os.stat(self._labels_file).st_mtime_ns
+        if mtime != self._labels_mtime:
+            with self._lock:
+                if mtime != self._labels_mtime:
+                    with open(self._labels_file) as f:
+                        self._labels, self._labels_mtime = json.load(f), mtime
+        return self._labels
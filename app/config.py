@@ -14,3 +14,130 @@ class Configuration:
         "vgg16",
         "inception_v3",
     )
+
+    # model registry
+    model_memory_budget_mb = None  # None means no limit
+    warm_up_models = ()  # models loaded at startup, e.g. models to preload all of them
+    # ready-to-load snapshots of the models, written by prepare_models.py
+    model_snapshots_enabled = True
+    model_snapshot_dir = os.path.join(project_root, "cache/models")
+
+    # multi-process server (python -m app.serve)
+    server_workers = 2
+    shared_models = models  # loaded before forking the workers, which share them
+
+    # micro-batching of concurrent requests for the same model
+    batching_enabled = True
+    max_batch_size = 32
+    max_batch_wait_ms = 5.0
+
+    # execution pools for the CPU-bound work of the handlers
+    inference_threads = 32  # at least max_batch_size, so that batches can fill
+    inference_queue_limit = 128
+    render_threads = 4
+    render_processes = 0  # when > 0, rendering runs in a process pool instead
+    render_queue_limit = 64
+    retry_after_s = 1  # Retry-After of the 503 responses sent when a queue is full
+
+    # asynchronous classification jobs (RQ)
+    redis_url = "redis://localhost:6379/0"  # fakeredis:// runs them in the web server, when enqueued
+    job_queue_name = "classifications"
+    job_timeout_s = 300
+    job_result_ttl_s = 600
+    job_max_wait_s = 30  # longest wait allowed when long-polling a job
+    job_poll_interval_s = 0.1
+
+    # cache of the classification results
+    result_cache_backend = None  # None (in-process only), "disk" or "redis"
+    result_cache_dir = os.path.join(project_root, "cache/results")
+    result_cache_max_entries = 10000
+    result_cache_ttl_s = 24 * 3600
+
+    # class probabilities of the catalog images precomputed by prepare_scores.py
+    score_index_enabled = True
+    score_index_path = os.path.join(project_root, "cache/scores")
+    score_index_batch_size = 64
+
+    # preprocessing
+    model_input_sizes = {"inception_v3": 299}  # the other models take 224 x 224 images
+    jpeg_draft_decode = True  # decode JPEG images at reduced size when possible
+    tensor_cache_mb = 256
+
+    # runtime of the models
+    torch_num_threads = None  # intra-op threads, None keeps the torch default
+    torch_interop_threads = None
+    # optimized variants "<model>:<variant>", selectable next to the models above,
+    # where variant is one of script, channels_last, int8 and int8-dynamic, e.g. "resnet18:int8".
+    # None is enabled by default: add one once benchmarks/variants.py has recorded its accuracy delta.
+    model_variants = ()
+    quantization_calibration_images = 32
+
+    # admission control of the classifications, by model and priority class
+    default_model_concurrency = 16  # running requests of a model
+    model_concurrency = {"vgg16": 4, "inception_v3": 4}
+    scheduler_queue_limits = {"interactive": 64, "batch": 512}  # waiting requests
+    request_timeouts_s = {"interactive": 10.0, "batch": 120.0}  # clients can ask for less with X-Timeout-Ms
+    scheduler_estimate_half_life_s = 30.0  # decay of the service time estimates without new measures
+
+    # batch classification API
+    api_images_in_flight = 8  # images decoded and classified at the same time
+    api_max_files = 256  # uploaded images in a multipart request
+    api_max_fields = 1024  # image_ids, model_ids and tiling fields in a multipart request
+
+    # uploads
+    max_request_body_bytes = 16 * 1024 ** 2
+    request_body_limits = {"/api/classifications": 1024 ** 3}  # per path overrides of max_request_body_bytes
+    upload_max_bytes = 10 * 1024 ** 2  # size of an uploaded image
+    upload_max_pixels = 50 * 10 ** 6  # protects against decompression bombs
+    upload_store_dir = os.path.join(project_root, "cache/uploads")
+    upload_store_max_bytes = 512 * 1024 ** 2
+    upload_store_ttl_s = 600
+
+    # plots of the classification scores
+    plot_cache_bytes = 32 * 1024 ** 2
+    plot_max_age_s = 24 * 3600
+
+    # histograms of the catalog images
+    histogram_index_path = os.path.join(project_root, "cache/histograms")
+    histogram_cache_entries = 10000
+    histogram_batch_max_images = 1000
+
+    # transformed images
+    transform_cache_bytes = 64 * 1024 ** 2
+    transform_max_age_s = 24 * 3600
+    transform_default_quality = 75  # JPEG and WebP quality, from 1 to 100
+
+    # thumbnails of the catalog images
+    thumbnail_dir = os.path.join(project_root, "cache/thumbnails")
+    thumbnail_sizes = (64, 128, 256, 512)  # side of the box the renditions fit in
+    thumbnail_quality = 85
+    thumbnail_max_age_s = 30 * 24 * 3600  # the URLs of the pages change with the catalog images
+    thumbnail_unversioned_max_age_s = 300  # URLs without the version of the image
+
+    # cropped catalog images packed by prepare_shards.py for the inference path
+    image_shards_enabled = True
+    image_shard_path = os.path.join(project_root, "cache/shards")
+
+    # similar-image search on the embeddings computed by prepare_embeddings.py
+    embedding_index_path = os.path.join(project_root, "cache/embeddings")
+    embedding_batch_size = 64
+    ivf_min_images = 50000  # the IVF index is used only for catalogs at least this large
+    ivf_probes = 8  # clusters scanned by a query
+    similar_max_k = 100
+
+    # tiled classification of large images (tiling=max or mean on /classifications_upload and the API)
+    tiling_scales = (1.0, 0.5)  # side of the square tiles, as a fraction of the short side of the image
+    tiling_overlap = 0.0  # fraction of the side of the tiles shared by their neighbours
+    tiling_max_tiles = 9  # including the central crop: 9 for a 4:3 or 3:2 photo, about 5x the latency of the crop
+    tiling_max_batch_mb = 64  # memory of the batch of tiles fed to the model
+
+    # on-demand profiling of the requests (see app/profiling.py)
+    profiling_enabled = False
+    profiling_token = None  # required with profiling_enabled, the X-Profile header must carry it
+    profiling_dir = os.path.join(project_root, "cache/profiles")
+    profiling_max_bytes = 256 * 1024 ** 2
+    profiling_max_requests = 100  # requests which can be armed at once with /admin/profiling
+
+    # Prometheus metrics, exposed at /metrics
+    metrics_enabled = True
+    metrics_buckets_s = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
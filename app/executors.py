@@ -0,0 +1,95 @@
+"""
+Execution layer for the CPU-bound work of the handlers (decoding, inference
+and rendering), so that it never runs on the asyncio event loop. Each pool
+accepts a limited number of pending tasks: when it is full, QueueFullError
+is raised and the request is answered with 503 and a Retry-After header.
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from app.config import Configuration
+from app.metrics import Gauge, metrics
+from app.profiling import current_profile
+
+conf = Configuration()
+
+
+class QueueFullError(Exception):
+    """Raised when a pool already holds its maximum number of tasks."""
+
+    def __init__(self, pool_name, retry_after):
+        super().__init__("The {} queue is full".format(pool_name))
+        self.pool_name = pool_name
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    """
+    Runs functions in an executor, accepting at most max_pending tasks
+    (running or waiting) at the same time.
+    """
+
+    def __init__(self, name, executor, max_pending, retry_after=1):
+        # functions run in threads are profiled with the request which runs them
+        self._profiled = isinstance(executor, ThreadPoolExecutor)
+        self.name = name
+        self._executor = executor
+        self._max_pending = max_pending
+        self._retry_after = retry_after
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) in the pool and returns its result.
+        Raises QueueFullError if the pool is full."""
+        with self._lock:
+            if self._pending >= self._max_pending:
+                raise QueueFullError(self.name, self._retry_after)
+            self._pending += 1
+        try:
+            call = functools.partial(fn, *args, **kwargs)
+            profile = current_profile() if self._profiled else None
+            if profile is not None:
+                call = functools.partial(profile.run, call)
+            if isinstance(self._executor, ThreadPoolExecutor):
+                # the function sees the context variables of the caller, e.g. its ModelTime
+                call = functools.partial(contextvars.copy_context().run, call)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, call)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+
+# torch releases the GIL in its kernels, so threads are enough for inference
+inference_pool = BoundedExecutor(
+    "inference",
+    ThreadPoolExecutor(conf.inference_threads, thread_name_prefix="inference"),
+    conf.inference_queue_limit,
+    conf.retry_after_s,
+)
+
+# PIL and matplotlib hold the GIL for most of their work, processes can be used instead
+render_pool = BoundedExecutor(
+    "render",
+    ProcessPoolExecutor(conf.render_processes) if conf.render_processes
+    else ThreadPoolExecutor(conf.render_threads, thread_name_prefix="render"),
+    conf.render_queue_limit,
+    conf.retry_after_s,
+)
+
+
+@metrics.collector
+def pool_metrics():
+    """Returns the number of tasks running or waiting in each pool."""
+    pending = Gauge("pool_pending_tasks", "Tasks running or waiting in the execution pools.", ("pool",))
+    for pool in (inference_pool, render_pool):
+        pending.set((pool.name,), pool.pending)
+    return [pending]
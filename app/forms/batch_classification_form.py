@@ -0,0 +1,63 @@
+from typing import List
+
+import starlette.datastructures
+from fastapi import Request, UploadFile
+
+from app.config import Configuration
+from app.ml.tiling import AGGREGATIONS
+
+
+class BatchClassificationForm:
+    """
+    Form of the batch classification API. It accepts either a JSON body
+    {"image_ids": [...], "model_ids": [...]} or a multipart form with
+    repeated image_ids and model_ids fields and uploaded "images" files.
+    An optional "tiling" field ("max" or "mean") enables the tiled classification.
+    A multipart form holds at most api_max_files files and api_max_fields other fields.
+    """
+
+    def __init__(self, request: Request) -> None:
+        self.request: Request = request
+        self.errors: List = []
+        self.image_ids: List[str] = []
+        self.uploads: List[UploadFile] = []
+        self.model_ids: List[str] = []
+        self.tiling = None
+
+    async def load_data(self):
+        if self.request.headers.get("content-type", "").startswith("application/json"):
+            try:
+                body = await self.request.json()
+            except ValueError:
+                self.errors.append("The body is not valid JSON")
+                return
+            if not isinstance(body, dict):
+                self.errors.append("The body must be a JSON object")
+                return
+            self.image_ids = body.get("image_ids") or []
+            self.model_ids = body.get("model_ids") or []
+            self.tiling = body.get("tiling") or None
+        else:
+            form = await self.request.form(
+                max_files=Configuration.api_max_files, max_fields=Configuration.api_max_fields
+            )
+            self.image_ids = form.getlist("image_ids")
+            self.uploads = form.getlist("images")
+            self.model_ids = form.getlist("model_ids")
+            self.tiling = form.get("tiling") or None
+
+    def is_valid(self):
+        if not isinstance(self.image_ids, list) or not all(isinstance(i, str) for i in self.image_ids):
+            self.errors.append("image_ids must be a list of image ids")
+        if not all(isinstance(f, starlette.datastructures.UploadFile) for f in self.uploads):
+            self.errors.append("images must be uploaded files")
+        if not self.image_ids and not self.uploads:
+            self.errors.append("At least an image id or an uploaded image is required")
+        if not isinstance(self.model_ids, list) or not self.model_ids \
+                or not all(isinstance(m, str) for m in self.model_ids):
+            self.errors.append("A non-empty list of model ids is required")
+        if self.tiling is not None and self.tiling not in AGGREGATIONS:
+            self.errors.append("tiling must be one of {}".format(list(AGGREGATIONS)))
+        if not self.errors:
+            return True
+        return False
@@ -1,29 +1,70 @@
-from typing import List
+from io import BytesIO
+from typing import List, Optional
 
 import PIL
 import magic
+from PIL import Image
 
 import starlette.datastructures
 from fastapi import Request, UploadFile
 
 from app.config import Configuration
+from app.ml.tiling import AGGREGATIONS
+
+
+_MAGIC_BYTES_TO_READ = 2048  # magic package documentation on GitHub suggests reading at least 2048 bytes.
+
+
+def check_image_data(data):
+    """
+    Validates the bytes of an uploaded image, read with a limit of upload_max_bytes + 1:
+    size, JPEG magic bytes and number of pixels. Returns the list of errors and, if there
+    is none, the image with only its header parsed.
+    """
+    errors = []
+    max_bytes = Configuration.upload_max_bytes
+    if len(data) > max_bytes:
+        errors.append("The image is too large, the limit is {} MB".format(max_bytes // 1024 ** 2))
+
+    try:
+        if 'JPEG image' not in magic.from_buffer(data[:_MAGIC_BYTES_TO_READ]):
+            errors.append("You inserted a file which is not a valid JPEG image!")
+    except magic.MagicException:
+        errors.append("We couldn't recognize the file you sent! Are you sure it was a JPEG image?")
+    if errors:
+        return errors, None
+
+    # Only the header is parsed here, the pixels are decoded later by the classifier.
+    try:
+        image = Image.open(BytesIO(data))
+    except (PIL.UnidentifiedImageError, Image.DecompressionBombError):
+        return ["We couldn't recognize the image you sent! Are you sure it was a JPEG image?"], None
+    if image.width * image.height > Configuration.upload_max_pixels:
+        image.close()
+        return ["The image has too many pixels, the limit is {} megapixels".format(
+            Configuration.upload_max_pixels // 10 ** 6)], None
+    return [], image
 
 
 # https://fastapi.tiangolo.com/tutorial/request-forms-and-files/
 class ClassificationFormUpload:
-    _MAGIC_BYTES_TO_READ = 2048  # magic package documentation on GitHub suggests reading at least 2048 bytes.
-
     def __init__(self, request: Request) -> None:
         self.request: Request = request
         self.errors: List = []
         self.image_file: UploadFile
         self.image_id: str
         self.model_id: str
+        self.tiling: Optional[str] = None  # aggregation of the tiled classification
+        # The uploaded bytes are read only once: the validation, the decoding and the
+        # ephemeral store all use this buffer.
+        self.image_data: Optional[bytes] = None
+        self.image: Optional[Image.Image] = None
 
     async def load_data(self):
         form = await self.request.form()
         self.image_file = form.get("immagine")
         self.model_id = form.get("model_id")
+        self.tiling = form.get("tiling") or None
         self.image_id = self.image_file.filename
 
     async def is_valid(self):
@@ -32,14 +73,11 @@ class ClassificationFormUpload:
                 or not self.image_file.filename.endswith(".JPEG"):  # utils.list_images() accepts only '.JPEG' extension
             self.errors.append("A valid .JPEG image is required (check file extension, it must be uppercase too!)")
 
-        try:
+        if isinstance(self.image_file, starlette.datastructures.UploadFile):
             await self.image_file.seek(0)
-            if 'JPEG image' not in magic.from_buffer(
-                    await self.image_file.read(ClassificationFormUpload._MAGIC_BYTES_TO_READ)
-            ):
-                self.errors.append("You inserted a file which is not a valid JPEG image!")
-        except magic.MagicException:
-            self.errors.append("We couldn't recognize the file you sent! Are you sure it was a JPEG image?")
+            self.image_data = await self.image_file.read(Configuration.upload_max_bytes + 1)
+            errors, self.image = check_image_data(self.image_data)
+            self.errors.extend(errors)
 
         if not self.image_id or not isinstance(self.image_id, str):
             self.errors.append("A valid image filename is required")
@@ -47,12 +85,17 @@ class ClassificationFormUpload:
         if not self.model_id or not isinstance(self.model_id, str):
             self.errors.append("A valid model id is required")
 
+        if self.tiling is not None and self.tiling not in AGGREGATIONS:
+            self.errors.append("The tiling must be one of {}".format(list(AGGREGATIONS)))
+
+        # The content is in image_data now, the temporary file is not needed anymore
+        if isinstance(self.image_file, starlette.datastructures.UploadFile):
+            await self.image_file.close()
         if not self.errors:
             return True
         # Deny default
-        # If any error happens, get rid of the image_file without waiting for garbage collection
-        await self.image_file.close()   # This should close its internal SpooledTemporaryFile,
-                                        # effectively eliminating it from memory in case an error occurs.
-                                        # We just explicitly insert this line for readability,
-                                        # But it should get executed by python's garbage collector too!
+        if self.image is not None:
+            self.image.close()
+            self.image = None
+        self.image_data = None
         return False
@@ -1,6 +1,6 @@
 from typing import List
 from fastapi import Request
-from app.image_transform import TransformWrapper
+from app.image_transform import transform_wrapper
 
 
 class TransformImageForm:
@@ -13,7 +13,7 @@ class TransformImageForm:
     async def load_data(self):
         form = await self.request.form()
         self.image_id = form.get("image_id")
-        for t in TransformWrapper().transforms:
+        for t in transform_wrapper.transforms:
             self.transforms.update({t: form.get(t)})
 
     def is_valid(self):
@@ -0,0 +1,63 @@
+"""
+Per-channel histograms of the catalog images, computed server-side with
+vectorized NumPy. Histograms are cached per image digest, and can be
+precomputed for the whole catalog with prepare_histograms.py.
+"""
+import numpy as np
+
+from app.config import Configuration
+from app.ml.classification_utils import catalog_image_digest, fetch_image
+from app.ml.result_cache import ResultCache, export_metrics
+from app.ml.score_index import ScoreIndex
+
+conf = Configuration()
+
+CHANNELS = ("red", "green", "blue", "luminance")
+# name under which the histograms are stored in the cache and in the index
+INDEX_NAME = "histograms"
+# images computed by each task of a batch request
+HISTOGRAM_CHUNK = 32
+
+histogram_cache = export_metrics("histograms", ResultCache(conf.histogram_cache_entries, conf.result_cache_ttl_s))
+histogram_index = ScoreIndex(conf.histogram_index_path)
+
+
+def compute_histogram(img):
+    """Returns the histograms of the red, green, blue and luminance
+    channels of the image, as a (4, 256) uint32 array."""
+    rgb = np.asarray(img.convert("RGB"))
+    r, g, b = (rgb[..., i].ravel() for i in range(3))
+    # same integer ITU-R 601-2 luma transform as PIL's convert("L"), in uint32
+    # arrays: with the value-based casting of numpy < 2, uint8 * a uint32 scalar is only uint16
+    r32, g32, b32 = (c.astype(np.uint32) for c in (r, g, b))
+    luminance = (r32 * 19595 + g32 * 38470 + b32 * 7471 + 0x8000) >> 16
+    return np.stack([np.bincount(c, minlength=256) for c in (r, g, b, luminance)]).astype(np.uint32)
+
+
+def compute_catalog_histogram(image_id):
+    img = fetch_image(image_id)
+    try:
+        return compute_histogram(img)
+    finally:
+        img.close()
+
+
+def compute_catalog_histograms(image_ids):
+    return [compute_catalog_histogram(image_id) for image_id in image_ids]
+
+
+def lookup_histogram(image_id):
+    """Returns the digest of the catalog image and its histograms if they
+    are cached or precomputed, otherwise None."""
+    digest = catalog_image_digest(image_id)
+    histogram = histogram_cache.get(INDEX_NAME, digest)
+    if histogram is None:
+        row = histogram_index.lookup(INDEX_NAME, image_id, digest)
+        if row is not None:
+            histogram = np.array(row).reshape(len(CHANNELS), 256)
+            histogram_cache.put(INDEX_NAME, digest, histogram)
+    return digest, histogram
+
+
+def histogram_to_dict(histogram):
+    return {name: counts.tolist() for name, counts in zip(CHANNELS, histogram)}
@@ -1 +1 @@
-from .transform_wrapper import TransformWrapper
\ No newline at end of file
+from .transform_wrapper import TransformWrapper, transform_wrapper
@@ -0,0 +1,133 @@
+"""
+Fused implementation of the ImageEnhance chain Color -> Contrast ->
+Brightness -> Sharpness for RGB images.
+
+Each step of ImageEnhance is an Image.blend of the image with a degenerate
+image (its grayscale, its mean gray, black, its SMOOTH filtered version).
+Here Color is computed in NumPy over the three planes of the image, in
+strips of rows small enough to stay in cache: the grayscale, the blend and
+the rounding in a single pass. Contrast and Brightness blend every level
+with a constant, so they are folded into a single lookup table applied
+with one Image.point call, which is faster than any NumPy pass over the
+pixels. Contrast needs the mean luminance of the colored image, read from
+its histogram. The SMOOTH filter used by Sharpness is computed with integer
+sums over the strips, and blended with the image in the same pass.
+
+Every blend reproduces the float32 arithmetic and the truncation of
+Pillow, so the output matches the ImageEnhance chain pixel for pixel
+(tolerance: 0 levels).
+"""
+import numpy as np
+from PIL import Image, ImageFilter
+
+# rows of the planes processed at once, small enough for the float32 strips to stay in cache
+STRIP_ROWS = 32
+
+
+def lerp(degenerate, image, factor, out, truncate=True):
+    """Image.blend(degenerate, image, factor) of float32 arrays of integer
+    levels, written to out, which may be image. degenerate may be a
+    scalar, 0 for black. Pillow computes degenerate + factor * (image -
+    degenerate) in float32, clips it to [0, 255] and truncates it; the
+    truncation can be left to the conversion to uint8 of the last blend.
+    A factor within [0, 1] cannot leave the range of its operands, so the
+    clipping is skipped."""
+    factor = np.float32(factor)
+    if isinstance(degenerate, (int, float)) and degenerate == 0:
+        np.multiply(image, factor, out=out)
+    else:
+        np.subtract(image, degenerate, out=out)
+        out *= factor
+        out += degenerate
+    if not 0 <= factor <= 1:
+        np.clip(out, np.float32(0), np.float32(255), out=out)
+    return np.trunc(out, out=out) if truncate else out
+
+
+def _strips(height):
+    for top in range(0, height, STRIP_ROWS):
+        yield top, min(top + STRIP_ROWS, height)
+
+
+def color_planes(planes, gray, factor):
+    """Image.blend(gray, planes, factor) of the (h, w) uint8 planes and
+    their grayscale."""
+    height, width = planes[0].shape
+    out = [np.empty((height, width), np.uint8) for _ in planes]
+    strip_buffer, gray_buffer = (np.empty((STRIP_ROWS, width), np.float32) for _ in range(2))
+    for top, bottom in _strips(height):
+        strip, gray_strip = strip_buffer[:bottom - top], gray_buffer[:bottom - top]
+        gray_strip[...] = gray[top:bottom]
+        for plane, dest in zip(planes, out):
+            strip[...] = plane[top:bottom]
+            # the conversion to uint8 truncates the levels
+            dest[top:bottom] = lerp(gray_strip, strip, factor, strip, truncate=False)
+    return out
+
+
+def blend_table(factor, degenerate):
+    """Returns the table of Image.blend(degenerate, image, factor) for the
+    256 levels of image, degenerate being a constant level."""
+    return lerp(float(degenerate), np.arange(256, dtype=np.float32), factor, np.empty(256, np.float32))
+
+
+def _smooth_rows(plane, top, bottom):
+    """ImageFilter.SMOOTH ([[1, 1, 1], [1, 5, 1], [1, 1, 1]] / 13) of the
+    rows top:bottom of an (h, w) uint8 plane, without the first and last
+    columns, as uint16 levels. The neighbour rows must exist."""
+    strip = plane[top - 1:bottom + 1].astype(np.uint16)
+    rows = strip[:, :-2] + strip[:, 1:-1]
+    rows += strip[:, 2:]
+    acc = rows[:-2] + rows[1:-1]
+    acc += rows[2:]
+    center = strip[1:-1, 1:-1]
+    for _ in range(4):
+        acc += center
+    # round(acc / 13) with the rounding of Pillow's float filter
+    acc *= 2
+    acc += 13
+    acc //= 26
+    return acc
+
+
+def sharpen(plane, factor):
+    """Image.blend(SMOOTH filtered plane, plane, factor) of an (h, w) uint8
+    plane, whose border pixels are unchanged, like those of SMOOTH."""
+    out = plane.copy()
+    height = plane.shape[0]
+    for top in range(1, height - 1, STRIP_ROWS):
+        bottom = min(top + STRIP_ROWS, height - 1)
+        degenerate = _smooth_rows(plane, top, bottom).astype(np.float32)
+        image = plane[top:bottom, 1:-1].astype(np.float32)
+        out[top:bottom, 1:-1] = lerp(degenerate, image, factor, image, truncate=False)
+    return out
+
+
+def fused_enhance(img, color=1.0, contrast=1.0, brightness=1.0, sharpness=1.0):
+    """Applies the ImageEnhance factors to the RGB image, in the order
+    Color, Contrast, Brightness, Sharpness. A factor of 1.0 is skipped."""
+    if img.mode != "RGB":
+        raise ValueError("fused_enhance supports only RGB images, got {}".format(img.mode))
+    if sharpness != 1.0 and min(img.size) < 3:
+        # no interior pixel to smooth, Pillow's filter handles the borders
+        img = fused_enhance(img, color, contrast, brightness)
+        return Image.blend(img.filter(ImageFilter.SMOOTH), img, sharpness)
+
+    if color != 1.0:
+        planes = color_planes([np.asarray(band) for band in img.split()], np.asarray(img.convert("L")), color)
+        img = Image.merge("RGB", [Image.fromarray(plane) for plane in planes])
+
+    table = np.arange(256, dtype=np.float32)
+    if contrast != 1.0:
+        # same mean as ImageEnhance.Contrast, from the luminance histogram
+        histogram = img.convert("L").histogram()
+        mean = int(sum(i * n for i, n in enumerate(histogram)) / sum(histogram) + 0.5)
+        table = blend_table(contrast, mean)
+    if brightness != 1.0:
+        table = blend_table(brightness, 0)[table.astype(np.intp)]
+    if contrast != 1.0 or brightness != 1.0:
+        img = img.point(table.astype(np.uint8).tolist() * 3)
+
+    if sharpness != 1.0:
+        img = Image.merge("RGB", [Image.fromarray(sharpen(np.asarray(band), sharpness)) for band in img.split()])
+    return img
@@ -1,11 +1,16 @@
 from PIL import ImageEnhance, Image
 
+from .fused_enhance import fused_enhance
+
 
 class TransformWrapper:
     """
     Wrapper class which enables the user to apply transformations.
     Default values use ImageEnhance
     """
+    # transformations that fused_enhance applies together, in its order
+    _FUSED = ("Color", "Contrast", "Brightness", "Sharpness")
+
     @staticmethod
     def set_transform_type(fun, name="name", min_value=0.0, max_value=2.0, default=1.0, step=0.1):
         """
@@ -54,7 +59,17 @@ class TransformWrapper:
         Function that applies the transformations in batch.
         Input: img (PIL Image), dictionary of transformation (name and value needed)
         """
+        values = {name: float(value) for name, value in transform.items()}
+        if img.mode == "RGB" and list(values) == [name for name in self._FUSED if name in values]:
+            factors = {
+                name.lower(): value for name, value in values.items() if value != self._transforms[name]['default']
+            }
+            return fused_enhance(img, **factors)
+
         e = img
-        for name, value in transform.items():
-            e = self.apply_single_transform(e, name, float(value))
+        for name, value in values.items():
+            e = self.apply_single_transform(e, name, value)
         return e
+
+
+transform_wrapper = TransformWrapper()
@@ -0,0 +1,106 @@
+"""
+Classification jobs run by RQ workers. The web server only enqueues the
+jobs and reports their status, so inference can be scaled horizontally
+with workers started on other hosts (see app/worker.py).
+"""
+from io import BytesIO
+
+import redis
+from PIL import Image, UnidentifiedImageError
+from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Callback, Job
+from rq.timeouts import JobTimeoutException
+
+from app.config import Configuration
+from app.ml.result_cache import image_digest
+
+conf = Configuration()
+
+_connection = None
+
+# messages returned for the failed jobs, by exception type; the tracebacks hold paths of the server
+_ERRORS = [
+    (JobTimeoutException, "The job timed out"),
+    (FileNotFoundError, "The image is not available"),
+    ((UnidentifiedImageError, Image.DecompressionBombError), "The image could not be decoded"),
+]
+_DEFAULT_ERROR = "The classification failed"
+
+
+def get_connection():
+    """Returns the connection to the Redis server in conf.redis_url.
+    The URL fakeredis:// uses an in-process fakeredis server instead
+    (fakeredis must be installed), see get_queue."""
+    global _connection
+    if _connection is None:
+        if conf.redis_url.startswith("fakeredis://"):
+            import fakeredis
+            _connection = fakeredis.FakeStrictRedis()
+        else:
+            _connection = redis.Redis.from_url(conf.redis_url)
+    return _connection
+
+
+def get_queue():
+    """Returns the queue of the jobs. With fakeredis:// no worker can reach
+    the server, so the jobs are run in-process when they are enqueued, which
+    allows to use the jobs offline (e.g. in tests)."""
+    in_process = conf.redis_url.startswith("fakeredis://")
+    return Queue(conf.job_queue_name, connection=get_connection(), is_async=not in_process)
+
+
+def classify_upload(model_id, image_bytes):
+    """Job function classifying an uploaded image, received as bytes."""
+    # imported here, so that the web server does not load torch for the jobs alone
+    from app.ml.classification_utils import classify
+    return classify(model_id, Image.open(BytesIO(image_bytes)), digest=image_digest(image_bytes))
+
+
+def job_failed(job, connection, exc_type, exc_value, traceback):
+    """Failure callback of the jobs: stores in the job meta the error reported
+    to the clients. The traceback stays in the failed job registry."""
+    job.meta["error"] = next((message for types, message in _ERRORS if issubclass(exc_type, types)), _DEFAULT_ERROR)
+    job.save_meta()
+
+
+def enqueue_classification(model_id, image_id):
+    """Enqueues the classification of a catalog image and returns the job id."""
+    job = get_queue().enqueue_call(
+        "app.ml.classification_utils.classify_image",
+        kwargs={"model_id": model_id, "img_id": image_id},
+        timeout=conf.job_timeout_s,
+        result_ttl=conf.job_result_ttl_s,
+        on_failure=Callback(job_failed),
+    )
+    return job.id
+
+
+def enqueue_upload_classification(model_id, image_bytes):
+    """Enqueues the classification of an uploaded image and returns the job id."""
+    job = get_queue().enqueue_call(
+        classify_upload,
+        args=(model_id, image_bytes),
+        timeout=conf.job_timeout_s,
+        result_ttl=conf.job_result_ttl_s,
+        on_failure=Callback(job_failed),
+    )
+    return job.id
+
+
+def get_job_status(job_id):
+    """Returns a dictionary with the status of the job and, once it is
+    finished, its classification scores, or the error if it failed.
+    Returns None for unknown jobs."""
+    try:
+        job = Job.fetch(job_id, connection=get_connection())
+    except NoSuchJobError:
+        return None
+    status = job.get_status()
+    data = {"job_id": job_id, "status": str(getattr(status, "value", status))}
+    if job.is_finished:
+        data["classification_scores"] = job.result
+    elif job.is_failed:
+        # set by job_failed, missing if the worker died
+        data["error"] = job.meta.get("error", _DEFAULT_ERROR)
+    return data
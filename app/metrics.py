@@ -0,0 +1,301 @@
+"""
+Metrics of the service, exposed in the Prometheus text format at /metrics:
+latency histograms of the HTTP requests by endpoint and of the stages of
+the requests (fetching, preprocessing, inference, rendering...) by model,
+request counters and in-flight gauges. Recording a value takes a lock and
+a few additions, so the metrics can be left on in production.
+
+The stages which run in a process pool (render_processes > 0) are not
+recorded, as their values stay in the worker processes.
+"""
+import bisect
+import contextvars
+import threading
+import time
+
+from fastapi.templating import Jinja2Templates
+from starlette.routing import Match
+
+from app.config import Configuration
+
+conf = Configuration()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in self._values.items()]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.type)]
+        for name, labels, value in self._samples():
+            lines.append("{}{} {}".format(name, _format_labels(self.labelnames, labels), _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    """A value which only increases, e.g. the number of requests."""
+
+    type = "counter"
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, labels, value):
+        """Sets the value, for counters kept elsewhere and copied at scrape time."""
+        with self._lock:
+            self._values[labels] = value
+
+
+class Gauge(_Metric):
+    """A value which goes up and down, e.g. the requests in progress."""
+
+    type = "gauge"
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """Counts the observed values, e.g. latencies, in cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets or conf.metrics_buckets_s))
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # one count per bucket, the +Inf one, then the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def _samples(self):
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        samples = []
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((self.name + "_bucket", labels + (_format_value(bound),), cumulative))
+            samples.append((self.name + "_sum", labels, counts[-1]))
+            samples.append((self.name + "_count", labels, cumulative))
+        return samples
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.type)]
+        for name, labels, value in self._samples():
+            names = self.labelnames + ("le",) if name.endswith("_bucket") else self.labelnames
+            lines.append("{}{} {}".format(name, _format_labels(names, labels), _format_value(value)))
+        return lines
+
+
+class MetricsRegistry:
+    """
+    The metrics of the process. Collectors are functions called at scrape
+    time, returning metrics built from the state of other components.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        """Returns all the metrics in the Prometheus text format."""
+        metrics = list(self._metrics)
+        for collect in self._collectors:
+            metrics.extend(collect())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+metrics = MetricsRegistry()
+
+http_requests = metrics.register(Counter(
+    "http_requests_total", "HTTP requests answered.", ("method", "endpoint", "status")
+))
+http_request_duration = metrics.register(Histogram(
+    "http_request_duration_seconds", "Time to answer the HTTP requests.", ("method", "endpoint")
+))
+http_requests_in_progress = metrics.register(Gauge(
+    "http_requests_in_progress", "HTTP requests being answered.", ("method", "endpoint")
+))
+stage_duration = metrics.register(Histogram(
+    "stage_duration_seconds", "Time spent in the stages of the requests, by model when it applies.",
+    ("stage", "model"),
+))
+template_render_duration = metrics.register(Histogram(
+    "template_render_duration_seconds", "Time to render the page templates.", ("template",)
+))
+classifications = metrics.register(Counter(
+    "classifications_total", "Classifications answered, by the source of their result.", ("model", "source")
+))
+inference_batch_size = metrics.register(Histogram(
+    "inference_batch_size", "Images in the batched forward passes.", ("model",),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+))
+
+
+class stage_timer:
+    """
+    Context manager recording the time spent in its block as the given stage:
+
+        with stage_timer("forward", model_id):
+            out = model(batch)
+    """
+
+    __slots__ = ("labels", "start")
+
+    def __init__(self, stage, model=""):
+        self.labels = (stage, model)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if conf.metrics_enabled:
+            stage_duration.observe(time.perf_counter() - self.start, self.labels)
+
+
+# the ModelTime of the request served in the current context
+_model_time = contextvars.ContextVar("model_time", default=None)
+
+
+class ModelTime:
+    """
+    Context manager adding up the time spent running models (see
+    model_timer) by the code run in its block, including the functions it
+    runs in the thread pools. seconds stays None when no model ran, e.g.
+    when the result came from a cache.
+    """
+
+    __slots__ = ("seconds", "_token")
+
+    def __init__(self):
+        self.seconds = None
+
+    def __enter__(self):
+        self._token = _model_time.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _model_time.reset(self._token)
+
+
+class model_timer:
+    """Context manager adding the time spent in its block to the current
+    ModelTime, if any. The block must only run a model already loaded."""
+
+    __slots__ = ("start",)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        account = _model_time.get()
+        if account is not None and exc_type is None:
+            account.seconds = (account.seconds or 0.0) + time.perf_counter() - self.start
+
+
+class TimedTemplates(Jinja2Templates):
+    """Jinja2Templates recording the time taken to render each template."""
+
+    def TemplateResponse(self, name, context, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().TemplateResponse(name, context, *args, **kwargs)
+        finally:
+            if conf.metrics_enabled:
+                template_render_duration.observe(time.perf_counter() - start, (name,))
+
+
+def endpoint_of(routes, scope):
+    """Returns the path template of the route matching the request, so that
+    the requests for different ids share their metrics, or "other"."""
+    for route in routes:
+        match, _ = route.matches(scope)
+        if match != Match.NONE:
+            return route.path
+    return "other"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting the HTTP requests and timing them until their
+    response is sent, by endpoint. routes is the list of the routes of the
+    application.
+    """
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        labels = (scope["method"], endpoint_of(self.routes, scope))
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_progress.inc(labels)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            http_request_duration.observe(time.perf_counter() - start, labels)
+            http_requests_in_progress.dec(labels)
+            http_requests.inc(labels + (str(status),))
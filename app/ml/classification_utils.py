@@ -2,92 +2,362 @@
 This is a simple classification service. It accepts an url of an
 image and returns the top-5 classification labels and scores.
 """
-import importlib
-import json
-import logging
 import os
+import threading
+import weakref
+import numpy as np
 import torch
 from PIL import Image
-from torchvision import transforms
 
 from app.config import Configuration
+from app.metrics import classifications, model_timer, stage_timer
+from app.profiling import forward_profiler
+from app.utils import catalog
+from app.ml.embeddings import EmbeddingIndex, embed, feature_extractor
+from app.ml.inference_engine import InferenceEngine
+from app.ml.model_registry import ModelRegistry, load_torchvision_model
+from app.ml.preprocessing import Preprocessor, TensorCache
+from app.ml.result_cache import DiskBackend, RedisBackend, ResultCache, export_metrics, image_digest
+from app.ml.runtime import ModelLoader, configure_threads, split_model_id
+from app.ml.score_index import ScoreIndex
+from app.ml.snapshots import SnapshotLoader
+from app.ml.tiling import aggregate, draft_size, tile_batch, tile_boxes
 
 conf = Configuration()
+configure_threads(conf.torch_num_threads, conf.torch_interop_threads)
+# builds the models and their variants from the pretrained torchvision models
+model_loader = ModelLoader(load_torchvision_model, lambda model_id: input_size(model_id),
+                           lambda model_id: calibration_batch(model_id))
+# the models without a snapshot written by prepare_models.py are built
+registry = ModelRegistry(
+    conf.models + conf.model_variants,
+    memory_budget_mb=conf.model_memory_budget_mb,
+    loader=SnapshotLoader(conf.model_snapshot_dir, model_loader) if conf.model_snapshots_enabled else model_loader,
+)
+engine = None
+if conf.batching_enabled:
+    engine = InferenceEngine(
+        registry.get, max_batch_size=conf.max_batch_size, max_wait_ms=conf.max_batch_wait_ms
+    )
+
+
+def _make_result_cache():
+    backend = None
+    if conf.result_cache_backend == "disk":
+        backend = DiskBackend(conf.result_cache_dir, conf.result_cache_max_entries, conf.result_cache_ttl_s)
+    elif conf.result_cache_backend == "redis":
+        from app.jobs import get_connection
+        backend = RedisBackend(get_connection(), conf.result_cache_ttl_s)
+    return ResultCache(conf.result_cache_max_entries, conf.result_cache_ttl_s, backend)
+
+
+result_cache = export_metrics("classifications", _make_result_cache())
+score_index = ScoreIndex(conf.score_index_path) if conf.score_index_enabled else None
+image_shards = ScoreIndex(conf.image_shard_path) if conf.image_shards_enabled else None
+embedding_index = EmbeddingIndex(
+    ScoreIndex(conf.embedding_index_path), conf.embedding_index_path, conf.ivf_min_images, conf.ivf_probes
+)
+# model -> feature extractor sharing its weights, dropped when the registry evicts the model
+_extractors = weakref.WeakKeyDictionary()
+_extractors_lock = threading.Lock()
+# image_id -> (mtime, size, digest), so that catalog images are hashed only once
+_catalog_digests = {}
+# one preprocessing pipeline per input size
+_preprocessors = {}
+tensor_cache = TensorCache(int(conf.tensor_cache_mb * 1024 ** 2))
 
 
 def fetch_image(image_id):
     """Gets the image from the specified ID. It returns only images
     downloaded in the folder specified in the configuration object."""
     image_path = os.path.join(conf.image_folder_path, image_id)
-    img = Image.open(image_path)
+    with stage_timer("fetch_image"):
+        img = Image.open(image_path)
     return img
 
 
+def catalog_image_digest(image_id):
+    """Returns the hash of the content of a catalog image. It is computed
+    again only if the file changes."""
+    image_path = os.path.join(conf.image_folder_path, image_id)
+    st = os.stat(image_path)
+    cached = _catalog_digests.get(image_id)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    with open(image_path, "rb") as f:
+        digest = image_digest(f.read())
+    _catalog_digests[image_id] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
 def get_labels():
     """Returns the labels of Imagenet dataset as a list, where
     the index of the list corresponds to the output class."""
-    labels_path = os.path.join(conf.image_folder_path, "imagenet_labels.json")
-    with open(labels_path) as f:
-        labels = json.load(f)
-    return labels
+    return catalog.labels()
 
 
 def get_model(model_id):
-    """Imports a pretrained model from the ones that are specified in
-    the configuration file. This is needed as we want to pre-download the
-    specified model in order to avoid unnecessary waits for the user."""
-    if model_id in conf.models:
-        try:
-            module = importlib.import_module("torchvision.models")
-            return module.__getattribute__(model_id)(weights="DEFAULT")
-        except ImportError:
-            logging.error("Model {} not found".format(model_id))
-    else:
-        raise ImportError
+    """Returns a pretrained model, in eval mode, from the ones that are
+    specified in the configuration file. Models are kept resident in the
+    registry, so they are built only the first time they are requested."""
+    return registry.get(model_id)
+
+
+def run_model(model_id, batch):
+    """Returns the output of the model for a batch of preprocessed images.
+    When batching is enabled, the batch is merged with the ones of the
+    concurrent requests for the same model."""
+    if engine is not None:
+        # loads the model first, so that its loading is not counted as model time
+        get_model(model_id)
+        with model_timer():
+            return engine.infer(model_id, batch)
+    with stage_timer("get_model", model_id):
+        model = get_model(model_id)
+    with model_timer(), stage_timer("forward", model_id), forward_profiler(model_id), torch.inference_mode():
+        return model(batch)
+
+
+def input_size(model_id):
+    """Returns the size of the (square) images expected by the model."""
+    base, _ = split_model_id(model_id or "")
+    return conf.model_input_sizes.get(base, 224)
+
+
+def get_preprocessor(size):
+    """Returns the preprocessing pipeline for the given input size."""
+    preprocessor = _preprocessors.get(size)
+    if preprocessor is None:
+        preprocessor = _preprocessors.setdefault(size, Preprocessor(size, draft=conf.jpeg_draft_decode))
+    return preprocessor
+
+
+def preprocess(img, model_id=None, digest=None):
+    """Returns the normalized tensor, of shape (3, size, size), which is
+    fed to the model for the image. If the digest of the image bytes is
+    given, the tensor is cached."""
+    size = input_size(model_id)
+    if digest is None:
+        with stage_timer("preprocess", model_id or ""):
+            return get_preprocessor(size)(img)
+    tensor = tensor_cache.get((digest, size))
+    if tensor is None:
+        with stage_timer("preprocess", model_id or ""):
+            tensor = get_preprocessor(size)(img)
+        tensor_cache.put((digest, size), tensor)
+    return tensor
+
+
+def shard_name(size):
+    """Returns the name of the shard of the catalog images cropped to size."""
+    return "images_{}".format(size)
+
+
+def preprocess_catalog_image(model_id, img_id, digest):
+    """Same as preprocess for a catalog image. The cropped image packed by
+    prepare_shards.py is used when available, instead of decoding the file."""
+    size = input_size(model_id)
+    tensor = tensor_cache.get((digest, size))
+    if tensor is not None:
+        return tensor
+    pixels = image_shards.lookup(shard_name(size), img_id, digest) if image_shards is not None else None
+    if pixels is not None:
+        # copies the (read-only) row of the shard
+        with stage_timer("preprocess_shard", model_id):
+            tensor = get_preprocessor(size).normalize(np.array(pixels).reshape(size, size, 3))
+        tensor_cache.put((digest, size), tensor)
+        return tensor
+    img = fetch_image(img_id)
+    try:
+        return preprocess(img, model_id, digest)
+    finally:
+        img.close()
+
+
+def calibration_batch(model_id):
+    """Returns the batch of the first catalog images used to calibrate
+    the statically quantized variant of the model."""
+    images = catalog.images()[:conf.quantization_calibration_images]
+    batch = []
+    for image_id in images:
+        img = fetch_image(image_id)
+        batch.append(preprocess(img, model_id))
+        img.close()
+    return torch.stack(batch)
+
+
+def top_scores(probabilities, k=5):
+    """Takes the top-k classification output from a vector of class
+    probabilities and returns it as a list of tuples (label_name, score),
+    where the scores are percentages."""
+    if not isinstance(probabilities, torch.Tensor):
+        # copies the (read-only) rows of the score index
+        probabilities = torch.from_numpy(np.array(probabilities, dtype=np.float32))
+    values, indices = torch.topk(probabilities * 100, k)
+    with stage_timer("get_labels"):
+        labels = get_labels()
+        return [[labels[idx], value] for idx, value in zip(indices.tolist(), values.tolist())]
 
 
 # function created to respect DRY principle
-def classify(model_id, img):
+def classify(model_id, img, digest=None):
     """Returns the top-5 classification score output from the
         model specified in model_id when it is fed with the
-        image stored temporarily in memory."""
+        image stored temporarily in memory. If the digest of the
+        image bytes is given, the result cache is used."""
+    try:
+        return classify_decoded(model_id, img, digest)
+    finally:
+        img.close()
+
+
+def decode(img, model_ids):
+    """Decodes the image once, so that it can be fed to several models.
+    JPEG images are drafted to the largest size needed by the models."""
+    if conf.jpeg_draft_decode and img.format == "JPEG":
+        size = max(get_preprocessor(input_size(model_id)).resize_size for model_id in model_ids)
+        img.draft("RGB", (size, size))
+    return img.convert("RGB")
+
+
+def classify_decoded(model_id, img, digest=None):
+    """Same as classify, but the image is left open, so that it can
+    be shared by several models (see decode)."""
+    if digest is None:
+        classifications.inc((model_id, "model"))
+        return _classify(model_id, img)
+    output = result_cache.get(model_id, digest)
+    if output is None:
+        output = _classify(model_id, img, digest)
+        result_cache.put(model_id, digest, output)
+        classifications.inc((model_id, "model"))
+    else:
+        classifications.inc((model_id, "cache"))
+    return output
 
-    model = get_model(model_id)
-    model.eval()
-    transform = transforms.Compose(
-        (
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        )
-    )
 
+def _classify(model_id, img, digest=None):
     # apply transform from torchvision
-    img = img.convert("RGB")
-    preprocessed = transform(img).unsqueeze(0)
+    return _classify_tensor(model_id, preprocess(img, model_id, digest))
+
+
+def _classify_tensor(model_id, tensor):
+    preprocessed = tensor.unsqueeze(0)
 
     # gets the output from the model
-    out = model(preprocessed)
-    _, indices = torch.sort(out, descending=True)
+    out = run_model(model_id, preprocessed)
+
+    # transforms scores as probabilities and takes the top-5
+    return top_scores(torch.nn.functional.softmax(out, dim=1)[0])
+
+
+def max_tiles(model_id):
+    """Returns the number of tiles of an image fed to the model, within the
+    tile and memory limits of the configuration."""
+    size = input_size(model_id)
+    by_memory = int(conf.tiling_max_batch_mb * 1024 ** 2) // (3 * size * size * 4)
+    return max(1, min(conf.tiling_max_tiles, by_memory))
+
+
+def decode_tiled(img, model_ids):
+    """Same as decode, for the tiled classification: JPEG images are drafted
+    to the size at which the smallest tiles keep the resolution of the models."""
+    if conf.jpeg_draft_decode and img.format == "JPEG":
+        size = max(get_preprocessor(input_size(model_id)).resize_size for model_id in model_ids)
+        img.draft("RGB", draft_size(img.width, img.height, conf.tiling_scales, size))
+    return img.convert("RGB")
 
-    # transforms scores as percentages
-    percentage = torch.nn.functional.softmax(out, dim=1)[0] * 100
 
-    # gets the labels
-    labels = get_labels()
+def classify_tiles(model_id, img, digest=None, aggregation="max"):
+    """Returns the top-5 classification scores of a decoded RGB image (see
+    decode_tiled), aggregated over its tiles. If the digest of the image
+    bytes is given, the result cache is used."""
+    limit = max_tiles(model_id)
+    # the tiles, and so the result, depend on the tiling settings
+    cache_key = "{}@tiled-{}-{}-{}-{}".format(
+        model_id, aggregation, ",".join(map(str, conf.tiling_scales)), conf.tiling_overlap, limit
+    )
+    output = result_cache.get(cache_key, digest) if digest is not None else None
+    if output is not None:
+        classifications.inc((model_id, "cache"))
+        return output
+    size = input_size(model_id)
+    with stage_timer("preprocess_tiles", model_id):
+        boxes = tile_boxes(
+            img.width, img.height, conf.tiling_scales, conf.tiling_overlap, limit, min_side=size
+        )
+        batch = tile_batch(img, boxes, get_preprocessor(size))
+    probabilities = torch.nn.functional.softmax(run_model(model_id, batch), dim=1)
+    output = top_scores(aggregate(probabilities, aggregation))
+    if digest is not None:
+        result_cache.put(cache_key, digest, output)
+    classifications.inc((model_id, "model"))
+    return output
+
+
+def classify_tiled(model_id, img, digest=None, aggregation="max"):
+    """Same as classify, with the tiled classification. The image is closed."""
+    try:
+        return classify_tiles(model_id, decode_tiled(img, [model_id]), digest, aggregation)
+    finally:
+        img.close()
+
+
+def get_feature_extractor(model_id):
+    """Returns the model computing the penultimate-layer features of model_id."""
+    model = get_model(model_id)
+    with _extractors_lock:
+        extractor = _extractors.get(model)
+        if extractor is None:
+            extractor = _extractors[model] = feature_extractor(model)
+    return extractor
+
+
+def compute_embedding(model_id, img):
+    """Returns the L2-normalized embedding of the image for the model."""
+    extractor = get_feature_extractor(model_id)
+    batch = preprocess(img, model_id).unsqueeze(0)
+    with model_timer():
+        return embed(extractor, batch)[0]
+
 
-    # takes the top-5 classification output and returns it
-    # as a list of tuples (label_name, score)
-    output = [[labels[idx], percentage[idx].item()] for idx in indices[0][:5]]
+def catalog_embedding(model_id, img_id):
+    """Returns the embedding of a catalog image, stored by prepare_embeddings.py
+    if it is up to date, otherwise computed."""
+    digest = catalog_image_digest(img_id)
+    vector = embedding_index.vector(model_id, img_id, digest)
+    if vector is None:
+        extractor = get_feature_extractor(model_id)
+        batch = preprocess_catalog_image(model_id, img_id, digest).unsqueeze(0)
+        with model_timer():
+            vector = embed(extractor, batch)[0]
+    return vector
 
-    img.close()
+
+def lookup_catalog_image(model_id, img_id, digest):
+    """Returns the top-5 classification scores of a catalog image if
+    they are cached or precomputed by prepare_scores.py, otherwise None."""
+    output = result_cache.get(model_id, digest)
+    if output is not None:
+        classifications.inc((model_id, "cache"))
+    elif score_index is not None:
+        probabilities = score_index.lookup(model_id, img_id, digest)
+        if probabilities is not None:
+            output = top_scores(probabilities)
+            result_cache.put(model_id, digest, output)
+            classifications.inc((model_id, "score_index"))
     return output
 
 
 def classify_image(model_id, img_id):
     """Returns the top-5 classification score output from the
     model specified in model_id when it is fed with the
-    image corresponding to img_id."""
-    img = fetch_image(img_id)
-    return classify(model_id, img)
+    image corresponding to img_id. The scores precomputed by
+    prepare_scores.py are used when available."""
+    digest = catalog_image_digest(img_id)
+    output = lookup_catalog_image(model_id, img_id, digest)
+    if output is None:
+        output = _classify_tensor(model_id, preprocess_catalog_image(model_id, img_id, digest))
+        result_cache.put(model_id, digest, output)
+        classifications.inc((model_id, "model"))
+    return output
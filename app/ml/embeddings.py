@@ -0,0 +1,175 @@
+"""
+Similar-image search over the catalog. The embedding of an image is the
+input of the last fully connected layer of a model (its penultimate-layer
+features), L2-normalized, so that the cosine similarity of two images is
+the dot product of their embeddings. prepare_embeddings.py stores the
+embeddings of the catalog in the score index format, one memory-mapped
+matrix per model, and a query is one matrix-vector product over it.
+
+For large catalogs, an IVF index can be built too: the embeddings are
+clustered with spherical k-means, and a query only scans the lists of the
+clusters closest to it.
+"""
+import copy
+import os
+import threading
+
+import numpy as np
+import torch
+from torch import nn
+
+# rows of the matrix multiplied at once by the exact search, bounding the temporary memory
+SEARCH_CHUNK_ROWS = 65536
+
+
+def index_name(model_id):
+    """Returns the name of the embeddings of model_id in the index."""
+    return "embeddings_{}".format(model_id)
+
+
+def feature_extractor(model):
+    """Returns a copy of the model whose last fully connected layer is
+    replaced by the identity, so that it outputs the penultimate-layer
+    features. The copy shares the weights of the model."""
+    names = [name for name, module in model.named_modules() if isinstance(module, nn.Linear)]
+    if not names:
+        raise ValueError("The model has no fully connected layer")
+    tensors = list(model.parameters()) + list(model.buffers())
+    extractor = copy.deepcopy(model, memo={id(t): t for t in tensors})
+    parent_name, _, child_name = names[-1].rpartition(".")
+    parent = extractor.get_submodule(parent_name) if parent_name else extractor
+    setattr(parent, child_name, nn.Identity())
+    return extractor.eval()
+
+
+def embed(extractor, batch):
+    """Returns the L2-normalized embeddings of a batch of preprocessed
+    images, as a float32 array (N, features)."""
+    with torch.inference_mode():
+        features = torch.flatten(extractor(batch), 1)
+    return torch.nn.functional.normalize(features, dim=1).numpy()
+
+
+def train_ivf(vectors, n_lists, iterations=10, sample_size=50000, seed=0):
+    """Clusters the L2-normalized vectors with spherical k-means and returns
+    the centroids (n_lists, features) and the list of every vector."""
+    rng = np.random.default_rng(seed)
+    n_lists = max(1, min(n_lists, len(vectors)))
+    sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # empty clusters keep their centroid
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+    lists = np.concatenate([
+        np.argmax(vectors[k:k + SEARCH_CHUNK_ROWS] @ centroids.T, axis=1)
+        for k in range(0, len(vectors), SEARCH_CHUNK_ROWS)
+    ])
+    return centroids, lists
+
+
+def ivf_path(directory, model_id):
+    return os.path.join(directory, index_name(model_id) + ".ivf.npz")
+
+
+def build_ivf(directory, model_id, rows, vectors, n_lists=None):
+    """Builds the IVF index of the embeddings of model_id and stores it
+    next to them. rows maps the image ids to their row in vectors."""
+    valid = np.array(sorted(r[0] for r in rows.values()), dtype=np.int64)
+    n_lists = n_lists or int(np.sqrt(len(valid))) or 1
+    centroids, lists = train_ivf(np.asarray(vectors[valid], dtype=np.float32), n_lists)
+    order = np.argsort(lists, kind="stable")
+    offsets = np.searchsorted(lists[order], np.arange(len(centroids) + 1))
+    path = ivf_path(directory, model_id)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, centroids=centroids, rows=valid[order], offsets=offsets)
+    os.replace(tmp_path, path)
+    return len(centroids)
+
+
+class EmbeddingIndex:
+    """
+    Read side of the embeddings stored by prepare_embeddings.py.
+    Input: score_index, the ScoreIndex of the embedding directory.
+    The IVF index is used when it exists, is not older than the
+    embeddings and the catalog has at least ivf_min_images images.
+    """
+
+    def __init__(self, score_index, directory, ivf_min_images, ivf_probes):
+        self._index = score_index
+        self._directory = directory
+        self._ivf_min_images = ivf_min_images
+        self._ivf_probes = ivf_probes
+        self._tables = {}  # model_id -> (rows, image ids by row, ivf or None)
+        self._lock = threading.Lock()
+
+    def _table(self, model_id):
+        table = self._index.table(index_name(model_id))
+        if table is None:
+            return None
+        rows, vectors = table
+        with self._lock:
+            cached = self._tables.get(model_id)
+            if cached is None or cached[0] is not rows:
+                ids = np.full(len(vectors), None, dtype=object)
+                for image_id, (row, _) in rows.items():
+                    ids[row] = image_id
+                cached = (rows, ids, self._load_ivf(model_id, len(rows)))
+                self._tables[model_id] = cached
+        return rows, vectors, cached[1], cached[2]
+
+    def _load_ivf(self, model_id, n_images):
+        path = ivf_path(self._directory, model_id)
+        rows_path = os.path.join(self._directory, index_name(model_id) + ".json")
+        if n_images < self._ivf_min_images or not os.path.exists(path) or \
+                os.path.getmtime(path) < os.path.getmtime(rows_path):
+            return None
+        with np.load(path) as ivf:
+            return ivf["centroids"], ivf["rows"], ivf["offsets"]
+
+    def has_embeddings(self, model_id):
+        """Tells whether prepare_embeddings.py has computed the embeddings of the model."""
+        return self._index.table(index_name(model_id)) is not None
+
+    def vector(self, model_id, image_id, digest):
+        """Returns the stored embedding of a catalog image, or None if it is
+        not indexed or has changed since it was indexed."""
+        row = self._index.lookup(index_name(model_id), image_id, digest)
+        return None if row is None else np.asarray(row, dtype=np.float32)
+
+    def search(self, model_id, vector, k=10, exclude=None):
+        """Returns the k catalog images most similar to the embedding, as a
+        list of (image_id, cosine similarity), most similar first, without
+        the image exclude. Returns None if the embeddings of the model have
+        not been computed."""
+        table = self._table(model_id)
+        if table is None:
+            return None
+        _, vectors, ids, ivf = table
+        vector = np.asarray(vector, dtype=vectors.dtype)
+        if ivf is not None:
+            centroids, ivf_rows, offsets = ivf
+            probes = np.argsort(centroids @ vector)[::-1][:self._ivf_probes]
+            candidates = np.sort(np.concatenate([ivf_rows[offsets[p]:offsets[p + 1]] for p in probes]))
+            scores = vectors[candidates] @ vector
+        else:
+            candidates = None
+            scores = np.concatenate([
+                vectors[start:start + SEARCH_CHUNK_ROWS] @ vector for start in range(0, len(vectors), SEARCH_CHUNK_ROWS)
+            ])
+        # one more than k, in case exclude is among them, and some more for the free rows
+        n = min(k + 1 + (len(ids) - len(table[0])), len(scores))
+        best = np.argpartition(-scores, n - 1)[:n] if n < len(scores) else np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        results = []
+        for i in best:
+            image_id = ids[candidates[i] if candidates is not None else i]
+            if image_id is None or image_id == exclude:
+                continue
+            results.append((image_id, float(scores[i])))
+            if len(results) == k:
+                break
+        return results
@@ -0,0 +1,131 @@
+"""
+Dynamic micro-batching of the forward passes. Concurrent requests for the
+same model are queued and merged into a single batched forward pass, which
+uses the CPU much better than many batches of one image.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from app.metrics import inference_batch_size, stage_timer
+from app.profiling import current_profile, forward_profiler
+
+
+class _Request:
+    """A batch of preprocessed images waiting for its forward pass."""
+
+    __slots__ = ("batch", "future", "profile")
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.future = Future()
+        self.profile = current_profile()
+
+
+class InferenceEngine:
+    """
+    Queues the preprocessed tensors per model and runs them in batches of at
+    most max_batch_size images, waiting at most max_wait_ms for a batch to fill.
+    Input: get_model, a function returning the model for a model id.
+    """
+
+    def __init__(self, get_model, max_batch_size=32, max_wait_ms=5.0):
+        self._get_model = get_model
+        self._max_batch_size = max(1, int(max_batch_size))
+        self._max_wait = max_wait_ms / 1000
+        self._queues = {}
+        self._workers = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def submit(self, model_id, batch):
+        """Enqueues a tensor of shape (N, C, H, W) for model_id and returns a
+        Future whose result is the (N, num_classes) output of the model."""
+        request = _Request(batch)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The inference engine has been shut down")
+            if model_id not in self._queues:
+                self._queues[model_id] = queue.SimpleQueue()
+                worker = threading.Thread(
+                    target=self._serve, args=(model_id, self._queues[model_id]),
+                    name="inference-{}".format(model_id), daemon=True,
+                )
+                self._workers[model_id] = worker
+                worker.start()
+            self._queues[model_id].put(request)
+        return request.future
+
+    def infer(self, model_id, batch):
+        """Blocking version of submit."""
+        return self.submit(model_id, batch).result()
+
+    def shutdown(self):
+        """Stops the workers once the requests already queued are served.
+        Workers are started again by the next submit."""
+        with self._lock:
+            self._closed = True
+            for q in self._queues.values():
+                q.put(None)
+            workers = list(self._workers.values())
+        for worker in workers:
+            worker.join()
+        with self._lock:
+            self._queues.clear()
+            self._workers.clear()
+            self._closed = False
+
+    def _serve(self, model_id, requests):
+        leftover = None
+        stopping = False
+        while True:
+            first = leftover if leftover is not None else requests.get()
+            leftover = None
+            if first is None:
+                return
+            pending, size = [first], len(first.batch)
+            deadline = time.monotonic() + self._max_wait
+            while size < self._max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                # tensors of a different shape, or too many of them, go in the next batch
+                if request.batch.shape[1:] != first.batch.shape[1:] \
+                        or size + len(request.batch) > self._max_batch_size:
+                    leftover = request
+                    break
+                pending.append(request)
+                size += len(request.batch)
+            self._run(model_id, pending)
+            if stopping:
+                return
+
+    def _run(self, model_id, pending):
+        pending = [r for r in pending if r.future.set_running_or_notify_cancel()]
+        if not pending:
+            return
+        try:
+            with stage_timer("get_model", model_id):
+                model = self._get_model(model_id)
+            batch = torch.cat([r.batch for r in pending])
+            inference_batch_size.observe(len(batch), (model_id,))
+            # the batch is recorded with the first profiled request in it
+            profile = next((r.profile for r in pending if r.profile is not None), None)
+            with stage_timer("forward", model_id), forward_profiler(model_id, profile), torch.inference_mode():
+                out = model(batch)
+        except BaseException as e:
+            for r in pending:
+                r.future.set_exception(e)
+            return
+        for r, rows in zip(pending, torch.split(out, [len(r.batch) for r in pending])):
+            r.future.set_result(rows)
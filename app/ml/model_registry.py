@@ -0,0 +1,121 @@
+"""
+Keeps the pretrained classification models resident in memory, so that
+each request does not have to rebuild the network and reload its weights.
+Models are loaded lazily (or eagerly with warm_up) and evicted in
+least-recently-used order when the configured memory budget is exceeded.
+"""
+import importlib
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def load_torchvision_model(model_id):
+    """Builds the torchvision model called model_id with its default
+    pretrained weights."""
+    module = importlib.import_module("torchvision.models")
+    return module.__getattribute__(model_id)(weights="DEFAULT")
+
+
+def model_size_bytes(model):
+    """Returns the memory occupied by the weights and buffers of the
+    model, in bytes. The state dict is used, as quantized modules keep
+    their packed weights out of parameters()."""
+    tensors = []
+    for value in model.state_dict().values():
+        tensors.extend(value if isinstance(value, tuple) else (value,))
+    if isinstance(model, torch.jit.ScriptModule):
+        # frozen TorchScript modules keep their weights as constants of the graph
+        for node in model.graph.findAllNodes("prim::Constant"):
+            if isinstance(node.output().type(), torch._C.TensorType):
+                tensors.append(node.output().toIValue())
+    return sum(t.nelement() * t.element_size() for t in tensors if isinstance(t, torch.Tensor))
+
+
+class ModelRegistry:
+    """
+    Thread-safe LRU registry of models in eval mode.
+    Input: the ids of the models that can be served, the memory budget
+    in MB (None means unlimited) and the function used to build a model
+    from its id.
+    """
+
+    def __init__(self, model_ids, memory_budget_mb=None, loader=load_torchvision_model):
+        self._model_ids = tuple(model_ids)
+        self._budget = None if memory_budget_mb is None else int(memory_budget_mb * 1024 ** 2)
+        self._loader = loader
+        self._models = OrderedDict()  # model_id -> (model, size in bytes)
+        self._lock = threading.Lock()
+        self._load_locks = {model_id: threading.Lock() for model_id in self._model_ids}
+
+    @property
+    def model_ids(self):
+        return self._model_ids
+
+    @property
+    def loaded(self):
+        """Ids of the resident models, from the least to the most recently used."""
+        with self._lock:
+            return list(self._models)
+
+    @property
+    def memory_usage(self):
+        """Memory occupied by the resident models, in bytes."""
+        with self._lock:
+            return sum(size for _, size in self._models.values())
+
+    def get(self, model_id):
+        """Returns the resident model for model_id, loading it if needed.
+        Raises ImportError if the model is not in the configuration."""
+        if model_id not in self._load_locks:
+            raise ImportError("Model {} is not available".format(model_id))
+
+        model = self._lookup(model_id)
+        if model is not None:
+            return model
+
+        # only one thread builds a given model, the others wait for it
+        with self._load_locks[model_id]:
+            model = self._lookup(model_id)
+            if model is not None:
+                return model
+            model = self._loader(model_id)
+            model.eval()
+            self._insert(model_id, model)
+            return model
+
+    def warm_up(self, model_ids=None):
+        """Eagerly loads the given models (all the configured ones if None)."""
+        for model_id in self._model_ids if model_ids is None else model_ids:
+            self.get(model_id)
+            logging.info("Model {} loaded".format(model_id))
+
+    def evict(self, model_id):
+        """Removes model_id from memory, if it is resident."""
+        with self._lock:
+            self._models.pop(model_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+    def _lookup(self, model_id):
+        with self._lock:
+            entry = self._models.get(model_id)
+            if entry is None:
+                return None
+            self._models.move_to_end(model_id)
+            return entry[0]
+
+    def _insert(self, model_id, model):
+        size = model_size_bytes(model)
+        with self._lock:
+            self._models[model_id] = (model, size)
+            if self._budget is None:
+                return
+            # the model just loaded is always kept, even if it exceeds the budget alone
+            while len(self._models) > 1 and sum(s for _, s in self._models.values()) > self._budget:
+                evicted, _ = self._models.popitem(last=False)
+                logging.info("Model {} evicted from memory".format(evicted))
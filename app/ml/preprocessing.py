@@ -0,0 +1,77 @@
+"""
+Preprocessing of the images fed to the models. JPEG images are decoded
+directly at a reduced size with PIL's draft mode (the downscaling is done
+in the DCT domain), one pipeline is reused for each input size, and the
+normalized tensors are cached with bounded memory. The cropped images can
+also be packed in advance by prepare_shards.py.
+"""
+import threading
+from collections import OrderedDict
+
+from torchvision import transforms
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+class Preprocessor:
+    """
+    Resizes the shorter side of the image to resize_size (crop_size * 256 / 224
+    by default), takes the central crop_size x crop_size crop and normalizes it.
+    With draft=True, JPEG images are decoded at the smallest scale which is
+    still larger than resize_size.
+    """
+
+    def __init__(self, crop_size, resize_size=None, draft=True):
+        self.crop_size = crop_size
+        self.resize_size = resize_size or round(crop_size * 256 / 224)
+        self.draft = draft
+        self._crop = transforms.Compose((transforms.Resize(self.resize_size), transforms.CenterCrop(crop_size)))
+        self._normalize = transforms.Compose((transforms.ToTensor(), transforms.Normalize(mean=MEAN, std=STD)))
+
+    def __call__(self, img):
+        """Returns the normalized tensor, of shape (3, crop_size, crop_size).
+        The draft mode works only if the image has not been loaded yet."""
+        return self._normalize(self.crop(img))
+
+    def crop(self, img):
+        """Returns the resized and cropped RGB image, before normalization."""
+        if self.draft and img.format == "JPEG":
+            img.draft("RGB", (self.resize_size, self.resize_size))
+        return self._crop(img.convert("RGB"))
+
+    def normalize(self, pixels):
+        """Returns the normalized tensor of a cropped image, or of its
+        (crop_size, crop_size, 3) uint8 array."""
+        return self._normalize(pixels)
+
+
+class TensorCache:
+    """Thread-safe LRU cache of tensors, holding at most max_bytes of data."""
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tensor = self._entries.get(key)
+            if tensor is not None:
+                self._entries.move_to_end(key)
+            return tensor
+
+    def put(self, key, tensor):
+        size = tensor.nelement() * tensor.element_size()
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nelement() * old.element_size()
+            self._entries[key] = tensor
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nelement() * evicted.element_size()
@@ -0,0 +1,170 @@
+"""
+Cache of the classification results, keyed by model id and a hash of the
+image bytes, so that identical images (catalog images or uploads) are
+classified only once. Results are kept in an in-process LRU and, optionally,
+in a persistent tier on disk or in Redis. The hits and misses of the caches
+registered with export_metrics are exposed at /metrics.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from app.metrics import Counter, Gauge, metrics
+
+# name -> ResultCache, see export_metrics
+_exported = {}
+
+
+def image_digest(image_bytes):
+    """Returns the hash identifying the content of an image."""
+    return hashlib.blake2b(image_bytes, digest_size=20).hexdigest()
+
+
+class DiskBackend:
+    """Persistent tier storing each result as a small JSON file in directory."""
+
+    def __init__(self, directory, max_entries, ttl_s):
+        self._directory = directory
+        self._max_entries = max_entries
+        self._ttl = ttl_s
+        self._puts = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + ".json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self._ttl:
+                os.remove(path)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+        # listing the directory is expensive, so it is pruned only once in a while
+        self._puts += 1
+        if self._puts % max(1, self._max_entries // 10) == 0:
+            self._prune()
+
+    def _prune(self):
+        """Removes the oldest files when there are more than max_entries."""
+        with os.scandir(self._directory) as it:
+            entries = [e for e in it if e.name.endswith(".json")]
+        if len(entries) <= self._max_entries:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[:len(entries) - self._max_entries]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+class RedisBackend:
+    """Persistent tier storing the results in Redis, which evicts them after ttl_s."""
+
+    def __init__(self, connection, ttl_s, prefix="classification:"):
+        self._connection = connection
+        self._ttl = ttl_s
+        self._prefix = prefix
+
+    def get(self, key):
+        value = self._connection.get(self._prefix + key)
+        return None if value is None else json.loads(value)
+
+    def put(self, key, value):
+        self._connection.set(self._prefix + key, json.dumps(value), ex=self._ttl)
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache of classification results with time-to-live,
+    backed by an optional persistent tier (DiskBackend or RedisBackend).
+    """
+
+    def __init__(self, max_entries=10000, ttl_s=24 * 3600, backend=None):
+        self._max_entries = max_entries
+        self._ttl = ttl_s
+        self._backend = backend
+        self._entries = OrderedDict()  # key -> (expiry time, result)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model_id, digest):
+        return "{}-{}".format(model_id, digest)
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def get(self, model_id, digest):
+        """Returns the cached result, or None if there is none."""
+        key = self.key(model_id, digest)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+        value = self._backend.get(key) if self._backend is not None else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._remember(key, value)
+        return value
+
+    def put(self, model_id, digest, value):
+        key = self.key(model_id, digest)
+        self._remember(key, value)
+        if self._backend is not None:
+            self._backend.put(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+def export_metrics(name, cache):
+    """Exposes the hits, misses and entries of the cache at /metrics, with
+    the label cache=name. Returns the cache."""
+    _exported[name] = cache
+    return cache
+
+
+@metrics.collector
+def collect_metrics():
+    """Returns the statistics of the exported caches as Prometheus metrics."""
+    hits = Counter("result_cache_hits_total", "Lookups answered by the result caches.", ("cache",))
+    misses = Counter("result_cache_misses_total", "Lookups not answered by the result caches.", ("cache",))
+    entries = Gauge("result_cache_entries", "Results held in memory by the result caches.", ("cache",))
+    for name, cache in _exported.items():
+        stats = cache.stats
+        hits.set((name,), stats["hits"])
+        misses.set((name,), stats["misses"])
+        entries.set((name,), stats["entries"])
+    return [hits, misses, entries]
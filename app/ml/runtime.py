@@ -0,0 +1,101 @@
+"""
+Runtime settings of the models and optimized variants of them. A variant
+is selected with a model id of the form "<model>:<variant>", for example
+"resnet18:int8", where the variant is one of:
+
+- script: TorchScript module traced and frozen, so that constants are folded;
+- channels_last: model and inputs in the channels-last memory layout;
+- int8: statically quantized model (FX post-training quantization), whose
+  activations are calibrated on the first catalog images;
+- int8-dynamic: model whose linear layers are dynamically quantized, which
+  helps models with large fully connected layers like vgg16 and alexnet.
+"""
+import logging
+
+import torch
+from torch import nn
+
+VARIANTS = ("script", "channels_last", "int8", "int8-dynamic")
+
+
+def split_model_id(model_id):
+    """Returns the base model id and the variant (None for the fp32 model)."""
+    base, _, variant = model_id.partition(":")
+    return base, variant or None
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+    """Sets the number of threads used by torch (None keeps the default)."""
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # it can be set only before any inter-op parallel work starts
+            logging.warning("The number of inter-op threads of torch was already set")
+
+
+class ChannelsLast(nn.Module):
+    """Runs the wrapped model on inputs converted to the channels-last layout."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+
+def build_variant(model, variant, example_input, calibration_input=None):
+    """
+    Returns the optimized variant of the fp32 model in eval mode.
+    Input: example_input, a batch used to trace the model; calibration_input,
+    the batch used to calibrate the statically quantized model.
+    """
+    model.eval()
+    if variant == "script":
+        with torch.no_grad():
+            return torch.jit.freeze(torch.jit.trace(model, example_input))
+    if variant == "channels_last":
+        return ChannelsLast(model)
+    if variant == "int8-dynamic":
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if variant == "int8":
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+        qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+        prepared = prepare_fx(model, qconfig_mapping, (example_input,))
+        with torch.no_grad():
+            prepared(calibration_input if calibration_input is not None else example_input)
+        return convert_fx(prepared)
+    raise ImportError("Unknown model variant {}".format(variant))
+
+
+class ModelLoader:
+    """
+    Builds the models for the registry, including their variants.
+    Input: base_loader, building the fp32 model from its id; input_size,
+    returning the input size of a model; calibration_data, returning a
+    batch of preprocessed images for a model id.
+    """
+
+    def __init__(self, base_loader, input_size, calibration_data):
+        self._base_loader = base_loader
+        self._input_size = input_size
+        self._calibration_data = calibration_data
+
+    def __call__(self, model_id):
+        base, _ = split_model_id(model_id)
+        return self.derive(self._base_loader(base), model_id)
+
+    def derive(self, model, model_id):
+        """Returns the variant of model_id built from the fp32 model of its
+        base, or the model itself for an fp32 model id."""
+        base, variant = split_model_id(model_id)
+        if variant is None:
+            return model
+        size = self._input_size(base)
+        example_input = torch.zeros(1, 3, size, size)
+        calibration_input = self._calibration_data(base) if variant == "int8" else None
+        return build_variant(model, variant, example_input, calibration_input)
@@ -0,0 +1,122 @@
+"""
+Index of the class probabilities precomputed by app/prepare_scores.py for
+the catalog images. For each model, the probabilities are stored as rows
+of a memory-mapped .npy file, and a JSON file maps each image id to its
+row and to the digest of the image the row was computed from.
+The same format stores the histograms precomputed by prepare_histograms.py.
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+
+def _paths(directory, model_id):
+    return os.path.join(directory, model_id + ".npy"), os.path.join(directory, model_id + ".json")
+
+
+class ScoreIndex:
+    """Read side of the index. Files rewritten by a rebuild are reopened
+    the next time they are used."""
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._models = {}  # model_id -> (json mtime, {image_id: [row, digest]}, memmap)
+        self._lock = threading.Lock()
+
+    def lookup(self, model_id, image_id, digest):
+        """Returns the probabilities of the classes for the image, or None if
+        the image is not in the index or has changed since it was indexed."""
+        entry = self._open(model_id)
+        if entry is None:
+            return None
+        _, rows, scores = entry
+        row = rows.get(image_id)
+        if row is None or row[1] != digest:
+            return None
+        return scores[row[0]]
+
+    def table(self, model_id):
+        """Returns the rows ({image_id: [row, digest]}) and the memory-mapped
+        array of model_id, or None if there is no index. Both are shared and
+        must not be modified."""
+        entry = self._open(model_id)
+        return None if entry is None else entry[1:]
+
+    def _open(self, model_id):
+        scores_path, rows_path = _paths(self._directory, model_id)
+        try:
+            mtime = os.path.getmtime(rows_path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._models.get(model_id)
+            if entry is None or entry[0] != mtime:
+                with open(rows_path) as f:
+                    rows = json.load(f)["images"]
+                entry = (mtime, rows, np.load(scores_path, mmap_mode="r"))
+                self._models[model_id] = entry
+            return entry
+
+
+def update_index(directory, model_id, digests, compute_scores, batch_size=64, full=False, dtype=np.float16):
+    """
+    Builds or incrementally updates the index of model_id.
+    Input: digests, a dictionary {image_id: digest} of the catalog images;
+    compute_scores, a function returning an array (N, num_classes) of
+    probabilities for a list of N image ids, stored with the given dtype.
+    Only the images which are new or changed are computed, unless full is True.
+    Output: the number of images computed.
+    """
+    os.makedirs(directory, exist_ok=True)
+    scores_path, rows_path = _paths(directory, model_id)
+
+    old_rows, old_scores = {}, None
+    if not full and os.path.exists(rows_path) and os.path.exists(scores_path):
+        with open(rows_path) as f:
+            old_rows = json.load(f)["images"]
+        old_scores = np.load(scores_path, mmap_mode="r")
+
+    # unchanged images keep their row, the others are computed
+    rows = {i: r for i, r in old_rows.items() if digests.get(i) == r[1]}
+    todo = [i for i in digests if i not in rows]
+    if not todo and len(rows) == len(old_rows):
+        return 0
+
+    # rows of removed or changed images are reused for the new ones
+    n_old = len(old_scores) if old_scores is not None else 0
+    used = {r[0] for r in rows.values()}
+    free = sorted(set(range(n_old)) - used, reverse=True)
+    next_row = n_old
+    n_rows = n_old + max(len(todo) - len(free), 0)
+
+    tmp_scores_path = scores_path + ".tmp.npy"
+    scores = None
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        probabilities = np.asarray(compute_scores(batch))
+        if scores is None:
+            scores = np.lib.format.open_memmap(
+                tmp_scores_path, mode="w+", dtype=dtype, shape=(n_rows, probabilities.shape[1])
+            )
+            if n_old:
+                scores[:n_old] = old_scores
+        for image_id, p in zip(batch, probabilities):
+            if free:
+                row = free.pop()
+            else:
+                row, next_row = next_row, next_row + 1
+            scores[row] = p
+            rows[image_id] = [row, digests[image_id]]
+    # if images were only removed, the scores file is left as it is
+    if scores is not None:
+        scores.flush()
+        del scores
+        os.replace(tmp_scores_path, scores_path)
+
+    tmp_rows_path = rows_path + ".tmp"
+    with open(tmp_rows_path, "w") as f:
+        json.dump({"model_id": model_id, "images": rows}, f)
+    os.replace(tmp_rows_path, rows_path)
+    return len(todo)
@@ -0,0 +1,74 @@
+"""
+Ready-to-load snapshots of the models, written by prepare_models.py, so
+that the server does not rebuild the networks when it starts.
+
+Modules are saved with torch.save and loaded with mmap=True: the weights
+are mapped from the file instead of being read and copied, so loading is
+almost instantaneous and the pages are shared with the other processes
+mapping the same file. The "script" and "int8" variants are saved as
+frozen TorchScript, as FX quantized modules cannot be pickled.
+Snapshots execute code when they are loaded, like any pickle, so only
+the snapshot directory written by prepare_models.py must be used.
+"""
+import logging
+import os
+
+import torch
+
+from app.ml.runtime import split_model_id
+
+TORCHSCRIPT_VARIANTS = ("script", "int8")
+
+
+def snapshot_path(directory, model_id):
+    """Returns the path of the snapshot of model_id in directory."""
+    _, variant = split_model_id(model_id)
+    extension = ".ts" if variant in TORCHSCRIPT_VARIANTS else ".pt"
+    return os.path.join(directory, model_id.replace(":", "-") + extension)
+
+
+def save_snapshot(directory, model_id, model, example_input):
+    """Writes the snapshot of the model, replacing the previous one atomically.
+    example_input is used to trace the models saved as TorchScript."""
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(directory, model_id)
+    tmp_path = path + ".tmp"
+    model.eval()
+    if path.endswith(".ts"):
+        if not isinstance(model, torch.jit.ScriptModule):
+            with torch.no_grad():
+                model = torch.jit.freeze(torch.jit.trace(model, example_input))
+        torch.jit.save(model, tmp_path)
+    else:
+        torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_snapshot(path):
+    """Loads a snapshot written by save_snapshot, in eval mode."""
+    if path.endswith(".ts"):
+        return torch.jit.load(path, map_location="cpu").eval()
+    return torch.load(path, map_location="cpu", mmap=True, weights_only=False).eval()
+
+
+class SnapshotLoader:
+    """
+    Loads the models from their snapshot in directory when there is one,
+    otherwise builds them with loader. Snapshots which cannot be loaded,
+    e.g. because they were written by another version of torch, are
+    ignored with a warning.
+    """
+
+    def __init__(self, directory, loader):
+        self._directory = directory
+        self._loader = loader
+
+    def __call__(self, model_id):
+        path = snapshot_path(self._directory, model_id)
+        if os.path.exists(path):
+            try:
+                return load_snapshot(path)
+            except Exception as e:
+                logging.warning("Snapshot {} cannot be loaded, rebuilding the model: {}".format(path, e))
+        return self._loader(model_id)
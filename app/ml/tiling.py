@@ -0,0 +1,78 @@
+"""
+Tiled classification of large images. Instead of a single central crop,
+the image is cut into overlapping square tiles at several scales, so that
+the objects far from the center or small in the frame are seen by the
+model at a useful resolution. All the tiles go through the model in one
+batched forward pass, and their class probabilities are aggregated.
+"""
+import math
+
+import numpy as np
+import torch
+from PIL import Image
+
+AGGREGATIONS = ("max", "mean")
+# side of the central crop of the standard preprocessing, as a fraction of the short side
+CENTER_CROP = 224 / 256
+
+
+def _positions(length, side, stride):
+    """Returns the offsets of the tiles of side pixels evenly spread over
+    length pixels, at most stride pixels apart."""
+    count = math.ceil(max(length - side, 0) / stride) + 1
+    return [round(x) for x in np.linspace(0, length - side, count)] if count > 1 else [(length - side) // 2]
+
+
+def tile_boxes(width, height, scales, overlap, max_tiles, min_side=1):
+    """
+    Returns the boxes (left, upper, right, lower) of the tiles of an image:
+    the central crop of the standard preprocessing first, then a grid of
+    square tiles for each scale, whose side is the given fraction of the
+    short side of the image and which overlap by the given fraction. The
+    grids are added from the coarsest scale while they fit in max_tiles.
+    The scales whose tiles are smaller than min_side pixels are skipped,
+    as the model would only see them upsampled.
+    """
+    short = min(width, height)
+    side = max(1, round(short * CENTER_CROP))
+    boxes = [((width - side) // 2, (height - side) // 2, (width - side) // 2 + side, (height - side) // 2 + side)]
+    for scale in sorted(scales, reverse=True):
+        side = max(1, round(short * scale))
+        if side < min_side:
+            continue
+        stride = max(1, side * (1 - overlap))
+        xs, ys = _positions(width, side, stride), _positions(height, side, stride)
+        grid = [(x, y, x + side, y + side) for y in ys for x in xs]
+        grid = [box for box in grid if box not in boxes]
+        if len(boxes) + len(grid) > max_tiles:
+            break
+        boxes.extend(grid)
+    return boxes
+
+
+def draft_size(width, height, scales, resize_size):
+    """Returns the size at which the image must be decoded so that the
+    tiles of the finest scale keep at least resize_size pixels per side."""
+    factor = min(1.0, resize_size / (min(width, height) * min(min(scales), CENTER_CROP)))
+    return math.ceil(width * factor), math.ceil(height * factor)
+
+
+def tile_batch(img, boxes, preprocessor):
+    """Returns the batch (N, 3, size, size) of the tiles of the RGB image,
+    each resized to the input size of the model and normalized."""
+    size = preprocessor.crop_size
+    return torch.stack([
+        preprocessor.normalize(img.resize((size, size), resample=Image.BILINEAR, box=box))
+        for box in boxes
+    ])
+
+
+def aggregate(probabilities, method):
+    """Aggregates the class probabilities of the tiles (N, num_classes):
+    max keeps the highest probability of each class over the tiles, mean
+    averages them."""
+    if method == "max":
+        return probabilities.max(dim=0).values
+    if method == "mean":
+        return probabilities.mean(dim=0)
+    raise ValueError("The aggregation must be one of {}".format(list(AGGREGATIONS)))
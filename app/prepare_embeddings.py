@@ -0,0 +1,62 @@
+"""
+Computes the embeddings (L2-normalized penultimate-layer features) of
+every catalog image for every model, used by the similar-image search.
+Only new or changed images are computed, unless --full is given. With
+--ivf, an IVF index is also built for catalogs of at least ivf_min_images
+images (or any size with --ivf-lists).
+
+    python -m app.prepare_embeddings [--full] [--models resnet18 ...] [--ivf] [--ivf-lists N]
+"""
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from app.config import Configuration
+from app.ml.classification_utils import (
+    catalog_image_digest, get_feature_extractor, preprocess_catalog_image,
+)
+from app.ml.embeddings import build_ivf, embed, index_name
+from app.ml.score_index import ScoreIndex, update_index
+from app.utils import list_images
+
+conf = Configuration()
+
+
+def prepare_embeddings(models=None, full=False, ivf=False, ivf_lists=None, batch_size=None):
+    """Updates the embeddings of the given models (all the configured ones if None)."""
+    batch_size = batch_size or conf.embedding_batch_size
+    digests = {image_id: catalog_image_digest(image_id) for image_id in list_images()}
+    with ThreadPoolExecutor() as decoders:
+        for model_id in models or conf.models:
+            extractor = get_feature_extractor(model_id)
+
+            def load(image_id):
+                return preprocess_catalog_image(model_id, image_id, digests[image_id])
+
+            def compute_embeddings(image_ids):
+                return embed(extractor, torch.stack(list(decoders.map(load, image_ids))))
+
+            n = update_index(
+                conf.embedding_index_path, index_name(model_id), digests, compute_embeddings, batch_size, full,
+                dtype=np.float32,
+            )
+            logging.info("Embeddings of {} updated ({} images computed)".format(model_id, n))
+
+            if ivf and (ivf_lists or len(digests) >= conf.ivf_min_images):
+                rows, vectors = ScoreIndex(conf.embedding_index_path).table(index_name(model_id))
+                lists = build_ivf(conf.embedding_index_path, model_id, rows, vectors, ivf_lists)
+                logging.info("IVF index of {} built ({} lists)".format(model_id, lists))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--full", action="store_true", help="recompute every image")
+    parser.add_argument("--models", nargs="+", help="models, all the configured ones by default")
+    parser.add_argument("--ivf", action="store_true", help="build the IVF index of large catalogs")
+    parser.add_argument("--ivf-lists", type=int, help="clusters of the IVF index, sqrt(images) by default")
+    args = parser.parse_args()
+    prepare_embeddings(args.models, args.full, args.ivf or args.ivf_lists is not None, args.ivf_lists)
@@ -0,0 +1,40 @@
+"""
+Precomputes the histograms of every catalog image in one batch pass and
+stores them in a compact array file. Only new or changed images are
+computed, unless --full is given.
+
+    python -m app.prepare_histograms [--full]
+"""
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from app.config import Configuration
+from app.histogram import INDEX_NAME, compute_catalog_histogram
+from app.ml.classification_utils import catalog_image_digest
+from app.ml.score_index import update_index
+from app.utils import list_images
+
+conf = Configuration()
+
+
+def prepare_histograms(full=False, batch_size=256):
+    digests = {image_id: catalog_image_digest(image_id) for image_id in list_images()}
+    with ThreadPoolExecutor() as decoders:
+        def compute_histograms(image_ids):
+            return np.stack([h.ravel() for h in decoders.map(compute_catalog_histogram, image_ids)])
+
+        n = update_index(
+            conf.histogram_index_path, INDEX_NAME, digests, compute_histograms, batch_size, full, dtype=np.uint32
+        )
+    logging.info("Histogram index updated ({} images computed)".format(n))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--full", action="store_true", help="recompute every image")
+    args = parser.parse_args()
+    prepare_histograms(args.full)
@@ -1,34 +1,196 @@
+"""
+Prepares the image catalog from a source, which is the URL of the Imagenet
+sample archive by default, or a local .zip/.tar(.gz) archive or directory.
+Archives are downloaded to a temporary file in chunks and their entries
+are extracted one at a time, so the memory used does not depend on the
+size of the dataset. The CRC of the zip entries (and optionally the
+SHA-256 of the archive) is checked. Images already in the catalog with the
+expected size are skipped, and the whole step is skipped when the
+catalog is complete, so reruns are cheap.
+
+    python app/prepare_images.py [--source URL|ARCHIVE|DIR] [--sha256 HASH] [--verify]
+
+The pre-resized shards used by the inference path are packed afterwards by
+python -m app.prepare_shards.
+"""
+import argparse
+import hashlib
 import json
 import logging
 import os
 import shutil
-from io import BytesIO
+import tarfile
+import tempfile
+import zlib
 from urllib.request import urlopen
-from zipfile import ZipFile
+from zipfile import BadZipFile, ZipFile
 
 import requests
+from PIL import Image
 
 from config import Configuration
 
+IMAGENET_SAMPLE_URL = "https://github.com/EliSchwartz/imagenet-sample-images/archive/master.zip"
+# lists the prepared images with their size, to skip the work on reruns
+MANIFEST_NAME = ".manifest.json"
+CHUNK_SIZE = 1024 ** 2
+
+
+def _copy(src, path):
+    """Streams src into path through a temporary file, so that an
+    interrupted copy never leaves a truncated image."""
+    tmp_path = path + ".part"
+    try:
+        with open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def _file_crc(path):
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _is_present(path, size, crc=None):
+    try:
+        if os.path.getsize(path) != size:
+            return False
+    except OSError:
+        return False
+    return crc is None or _file_crc(path) == crc
+
+
+def _download(url, directory, sha256=None):
+    """Downloads url into a temporary file of directory, in chunks, and
+    returns its path."""
+    fd, path = tempfile.mkstemp(suffix=".download", dir=directory)
+    digest = hashlib.sha256()
+    with os.fdopen(fd, "wb") as dst, urlopen(url) as src:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            dst.write(chunk)
+    if sha256 is not None and digest.hexdigest() != sha256:
+        os.remove(path)
+        raise ValueError("The SHA-256 of {} is {}, expected {}".format(url, digest.hexdigest(), sha256))
+    return path
+
+
+def _check_sha256(path, sha256):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    if digest.hexdigest() != sha256:
+        raise ValueError("The SHA-256 of {} is {}, expected {}".format(path, digest.hexdigest(), sha256))
 
-def prepare_images():
-    """Downloads a subset of the Imagenet Dataset."""
+
+def _extract_zip(archive, img_folder, manifest, verify):
+    """Extracts the files of the zip archive, flattened into img_folder.
+    Reading an entry to its end checks its CRC."""
+    written = 0
+    with ZipFile(archive) as zfile:
+        for info in zfile.infolist():
+            name = os.path.basename(info.filename)
+            if info.is_dir() or not name or name.startswith("."):
+                continue
+            path = os.path.join(img_folder, name)
+            if not _is_present(path, info.file_size, info.CRC if verify else None):
+                with zfile.open(info) as src:
+                    _copy(src, path)
+                written += 1
+            manifest[name] = info.file_size
+    return written
+
+
+def _extract_tar(archive, img_folder, manifest, verify):
+    """Extracts the regular files of the tar archive, read as a stream,
+    flattened into img_folder."""
+    written = 0
+    with tarfile.open(archive, "r|*") as tfile:
+        for member in tfile:
+            name = os.path.basename(member.name)
+            if not member.isfile() or not name or name.startswith("."):
+                continue
+            path = os.path.join(img_folder, name)
+            if verify or not _is_present(path, member.size):
+                _copy(tfile.extractfile(member), path)
+                written += 1
+            manifest[name] = member.size
+    return written
+
+
+def _copy_directory(directory, img_folder, manifest, verify):
+    """Copies the images of a local directory, checking that they decode."""
+    written = 0
+    with os.scandir(directory) as it:
+        for entry in it:
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            size = entry.stat().st_size
+            path = os.path.join(img_folder, entry.name)
+            if verify:
+                with Image.open(entry.path) as img:
+                    img.verify()
+            if not _is_present(path, size):
+                with open(entry.path, "rb") as src:
+                    _copy(src, path)
+                written += 1
+            manifest[entry.name] = size
+    return written
+
+
+def _read_manifest(img_folder):
+    try:
+        with open(os.path.join(img_folder, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def prepare_images(source=None, sha256=None, verify=False):
+    """Downloads a subset of the Imagenet Dataset, or copies it from a
+    local archive or directory."""
     img_folder = Configuration().image_folder_path
-    if not os.path.exists(img_folder):
-        zip_url = (
-            "https://github.com/EliSchwartz/"
-            "imagenet-sample-images/archive/master.zip"
-        )
-        with urlopen(zip_url) as zipresp:
-            with ZipFile(BytesIO(zipresp.read())) as zfile:
-                zfile.extractall(img_folder)
-    sub_dir = os.path.join(img_folder, "imagenet-sample-images-master")
-    if os.path.exists(sub_dir):
-        files = os.listdir(sub_dir)
-        for f in files:
-            shutil.move(os.path.join(sub_dir, f), img_folder)
-        shutil.rmtree(sub_dir)
-    logging.info(f"Images downloaded and stored in {img_folder}.")
+    source = source or IMAGENET_SAMPLE_URL
+    os.makedirs(img_folder, exist_ok=True)
+
+    previous = _read_manifest(img_folder)
+    if not verify and previous is not None and previous["source"] == source and all(
+            _is_present(os.path.join(img_folder, name), size) for name, size in previous["files"].items()):
+        logging.info(f"Images already prepared in {img_folder}.")
+        return
+
+    files = {}
+    if os.path.isdir(source):
+        written = _copy_directory(source, img_folder, files, verify)
+    else:
+        downloaded = "://" in source
+        archive = _download(source, img_folder, sha256) if downloaded else source
+        try:
+            if sha256 is not None and not downloaded:
+                _check_sha256(archive, sha256)
+            if tarfile.is_tarfile(archive):
+                written = _extract_tar(archive, img_folder, files, verify)
+            else:
+                try:
+                    written = _extract_zip(archive, img_folder, files, verify)
+                except BadZipFile as e:
+                    raise ValueError("{} is corrupted: {}".format(source, e))
+        finally:
+            if downloaded:
+                os.remove(archive)
+
+    tmp_manifest = os.path.join(img_folder, MANIFEST_NAME + ".tmp")
+    with open(tmp_manifest, "w") as f:
+        json.dump({"source": source, "files": files}, f)
+    os.replace(tmp_manifest, os.path.join(img_folder, MANIFEST_NAME))
+    logging.info(f"Images stored in {img_folder} ({written} of {len(files)} files written).")
 
 
 def prepare_labels():
@@ -36,6 +198,9 @@ def prepare_labels():
     the index is the label ID of the class."""
     img_folder = Configuration().image_folder_path
     labels_path = os.path.join(img_folder, "imagenet_labels.json")
+    if os.path.exists(labels_path):
+        logging.info(f"Labels already stored in {labels_path}.")
+        return
     imagenet_labels_path = (
         "https://raw.githubusercontent.com/"
         "anishathalye/imagenet-simple-labels/"
@@ -49,5 +214,12 @@ def prepare_labels():
 
 
 if __name__ == "__main__":
-    prepare_images()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", help="URL, .zip/.tar archive or directory of the images")
+    parser.add_argument("--sha256", help="expected SHA-256 of the archive")
+    parser.add_argument("--verify", action="store_true",
+                        help="check the content of the images already present, not only their size")
+    args = parser.parse_args()
+    prepare_images(args.source, args.sha256, args.verify)
     prepare_labels()
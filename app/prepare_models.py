@@ -1,22 +1,69 @@
-import importlib
+"""
+Downloads the pretrained models and writes ready-to-load snapshots of
+them and of their variants (see app/ml/snapshots.py), so that the server
+maps them from disk instead of building them. The models are built in
+parallel by a process pool, one task per fp32 model: it is built from
+the pretrained torchvision weights, and its variants are derived from it.
+Existing snapshots are kept unless --force is given; they are never used
+to build the others, so --force rebuilds everything from the weights.
+
+    python -m app.prepare_models [--force] [--workers N] [--models resnet18 vgg16:int8 ...]
+"""
+import argparse
+import copy
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
 
-from config import Configuration
+from app.config import Configuration
+from app.ml.classification_utils import input_size, model_loader
+from app.ml.model_registry import load_torchvision_model
+from app.ml.runtime import split_model_id
+from app.ml.snapshots import save_snapshot, snapshot_path
 
 conf = Configuration()
 
 
-def prepare_models():
-    """Pre-downloads the models specified in the configuration object."""
-    for model_name in conf.models:
-        try:
-            module = importlib.import_module("torchvision.models")
-            # download model
-            _ = module.__getattribute__(model_name)(weights="DEFAULT")
-            del _  # free up memory
-        except ImportError:
-            logging.error("Model {} not found".format(model_name))
+def _init_worker(threads):
+    torch.set_num_threads(threads)
+
+
+def build_snapshots(base, model_ids):
+    """Builds the fp32 model base and the given variants of it (model_ids
+    may include base itself), and writes their snapshots. Returns their
+    paths. It runs in a worker process."""
+    model = load_torchvision_model(base)
+    size = input_size(base)
+    paths = []
+    for model_id in model_ids:
+        built = model if model_id == base else model_loader.derive(copy.deepcopy(model), model_id)
+        paths.append(save_snapshot(conf.model_snapshot_dir, model_id, built, torch.zeros(1, 3, size, size)))
+    return paths
+
+
+def prepare_models(model_ids=None, force=False, workers=None):
+    """Writes the snapshots of the given models (all the configured ones and
+    their variants if None)."""
+    model_ids = model_ids or conf.models + conf.model_variants
+    todo = [m for m in model_ids if force or not os.path.exists(snapshot_path(conf.model_snapshot_dir, m))]
+    groups = {}  # fp32 model -> model ids built from it
+    for model_id in todo:
+        groups.setdefault(split_model_id(model_id)[0], []).append(model_id)
+    workers = workers or min(len(groups), os.cpu_count()) or 1
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(max(1, os.cpu_count() // workers),)) as pool:
+        for group, paths in zip(groups.values(), pool.map(build_snapshots, groups, groups.values())):
+            for model_id, path in zip(group, paths):
+                logging.info("Snapshot of {} written to {}".format(model_id, path))
+    logging.info("{} snapshots written, {} up to date".format(len(todo), len(model_ids) - len(todo)))
 
 
 if __name__ == "__main__":
-    prepare_models()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--force", action="store_true", help="rebuild the existing snapshots")
+    parser.add_argument("--workers", type=int, help="processes, one per fp32 model up to the number of cores by default")
+    parser.add_argument("--models", nargs="+", help="model ids, all the configured models and variants by default")
+    args = parser.parse_args()
+    prepare_models(args.models, args.force, args.workers)
@@ -0,0 +1,55 @@
+"""
+Precomputes the class probabilities of every catalog image for every model,
+so that /classifications can serve them without running the models.
+Only new or changed images are computed, unless --full is given.
+
+    python -m app.prepare_scores [--full] [--models resnet18 ...]
+"""
+import argparse
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from app.config import Configuration
+from app.ml.classification_utils import catalog_image_digest, fetch_image, get_model, preprocess
+from app.ml.score_index import update_index
+from app.utils import list_images
+
+conf = Configuration()
+
+
+def _load(model_id, image_id):
+    img = fetch_image(image_id)
+    try:
+        return preprocess(img, model_id)
+    finally:
+        img.close()
+
+
+def prepare_scores(models=None, full=False, batch_size=None):
+    """Updates the score index of the given models (all the configured ones if None)."""
+    batch_size = batch_size or conf.score_index_batch_size
+    digests = {image_id: catalog_image_digest(image_id) for image_id in list_images()}
+    with ThreadPoolExecutor() as decoders:
+        for model_id in models or conf.models:
+            model = get_model(model_id)
+
+            def compute_scores(image_ids):
+                batch = torch.stack(list(decoders.map(functools.partial(_load, model_id), image_ids)))
+                with torch.inference_mode():
+                    return torch.nn.functional.softmax(model(batch), dim=1).numpy()
+
+            n = update_index(conf.score_index_path, model_id, digests, compute_scores, batch_size, full)
+            logging.info("Score index of {} updated ({} images computed)".format(model_id, n))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--full", action="store_true", help="recompute every image")
+    parser.add_argument("--models", nargs="+", choices=conf.models)
+    parser.add_argument("--batch-size", type=int)
+    args = parser.parse_args()
+    prepare_scores(args.models, args.full, args.batch_size)
@@ -0,0 +1,61 @@
+"""
+Decodes the catalog images, resizes and crops them to the input size of
+the models, and packs them into memory-mappable shards (one uint8 row of
+size x size x 3 pixels per image), from which /classifications reads them
+instead of decoding the JPEG files. The images are decoded in parallel by
+a process pool, one batch at a time, so the memory used is bounded. Only
+new or changed images are packed, unless --full is given.
+
+    python -m app.prepare_shards [--full] [--sizes 224 299] [--workers N]
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from PIL import Image
+
+from app.config import Configuration
+from app.ml.classification_utils import catalog_image_digest, input_size, shard_name
+from app.ml.preprocessing import Preprocessor
+from app.ml.score_index import update_index
+from app.utils import list_images
+
+conf = Configuration()
+
+
+def crop_images(size, image_ids):
+    """Returns the cropped images as an array (N, size * size * 3)."""
+    preprocessor = Preprocessor(size, draft=conf.jpeg_draft_decode)
+    rows = []
+    for image_id in image_ids:
+        with Image.open(os.path.join(conf.image_folder_path, image_id)) as img:
+            rows.append(np.asarray(preprocessor.crop(img)).ravel())
+    return np.stack(rows)
+
+
+def prepare_shards(sizes=None, full=False, workers=None, batch_size=256):
+    sizes = sizes or sorted({input_size(model_id) for model_id in conf.models})
+    digests = {image_id: catalog_image_digest(image_id) for image_id in list_images()}
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as pool:
+        for size in sizes:
+            def pack(image_ids):
+                chunk = max(1, -(-len(image_ids) // workers))
+                chunks = [image_ids[k:k + chunk] for k in range(0, len(image_ids), chunk)]
+                return np.concatenate(list(pool.map(partial(crop_images, size), chunks)))
+
+            n = update_index(conf.image_shard_path, shard_name(size), digests, pack, batch_size, full, dtype=np.uint8)
+            logging.info("Shard of the {0}x{0} images updated ({1} images packed)".format(size, n))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--full", action="store_true", help="pack every image again")
+    parser.add_argument("--sizes", type=int, nargs="+", help="input sizes, those of the models by default")
+    parser.add_argument("--workers", type=int, help="processes, all the cores by default")
+    args = parser.parse_args()
+    prepare_shards(args.sizes, args.full, args.workers)
@@ -0,0 +1,40 @@
+"""
+Generates the thumbnails of every catalog image in all the configured
+sizes, in parallel on all the cores. Thumbnails which are up to date are
+skipped, so it can be run again after the catalog changes.
+
+    python -m app.prepare_thumbnails [--workers N] [--sizes 128 256]
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from app.config import Configuration
+from app.thumbnails import render_thumbnails
+from app.utils import list_images
+
+conf = Configuration()
+
+
+def prepare_thumbnails(sizes=None, workers=None):
+    sizes = sorted(sizes or conf.thumbnail_sizes)
+    image_ids = list_images()
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as pool:
+        written = sum(pool.map(
+            partial(render_thumbnails, sizes=sizes), image_ids, chunksize=max(1, len(image_ids) // (workers * 8))
+        ))
+    logging.info("Thumbnails updated ({} written for {} images)".format(written, len(image_ids)))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, help="processes, all the cores by default")
+    parser.add_argument("--sizes", type=int, nargs="+", help="sizes among the configured ones, all by default")
+    args = parser.parse_args()
+    if args.sizes and not set(args.sizes) <= set(conf.thumbnail_sizes):
+        parser.error("the sizes must be among {}".format(conf.thumbnail_sizes))
+    prepare_thumbnails(args.sizes, args.workers)
@@ -0,0 +1,254 @@
+"""
+On-demand profiling of the live service (profiling_enabled, which requires
+profiling_token). A request is profiled when its X-Profile header carries
+profiling_token, or when it is one of the next N requests armed with
+POST /admin/profiling?requests=N, which also needs the token.
+
+The handler of a profiled request is run under cProfile, and so are the
+functions it runs in the thread pools; their statistics are merged in one
+pstats file. The forward passes of the request are recorded with
+torch.profiler as Chrome traces. The files are written to profiling_dir,
+which keeps the most recent ones within profiling_max_bytes, and their id
+is returned in the X-Profile-Id header of the response.
+
+The event loop runs the handlers of all the requests, so only one handler
+at a time is profiled with cProfile, and its profile also includes the
+handlers of the concurrent requests when they run between its awaits. The
+functions run in the thread pools are profiled in any case.
+"""
+import contextvars
+import cProfile
+import hmac
+import logging
+import os
+import pstats
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import torch
+from starlette.concurrency import run_in_threadpool
+
+from app.config import Configuration
+
+conf = Configuration()
+
+_current = contextvars.ContextVar("profile", default=None)
+# torch.profiler records one profile at a time
+_trace_lock = threading.Lock()
+
+
+def current_profile():
+    """Returns the profile of the request being served, or None."""
+    return _current.get()
+
+
+def _enable(profiler):
+    """Starts the profiler, unless another profiling tool is active
+    (Python 3.12 allows only one at a time)."""
+    try:
+        profiler.enable()
+        return True
+    except ValueError:
+        return False
+
+
+class RequestProfile:
+    """The profiles captured while serving one request, named after its id."""
+
+    def __init__(self, directory, request_name):
+        self.id = "{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+        self.request_name = request_name
+        self.files = []
+        self._directory = directory
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def add_stats(self, profiler):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+
+    def run(self, fn):
+        """Runs fn under cProfile in the current thread, where the request
+        is then the current one, and returns its result."""
+        token = _current.set(self)
+        profiler = cProfile.Profile()
+        enabled = _enable(profiler)
+        try:
+            return fn()
+        finally:
+            if enabled:
+                profiler.disable()
+                self.add_stats(profiler)
+            _current.reset(token)
+
+    def _path(self, suffix):
+        os.makedirs(self._directory, exist_ok=True)
+        path = os.path.join(self._directory, "{}.{}".format(self.id, suffix))
+        self.files.append(os.path.basename(path))
+        return path
+
+    def add_trace(self, model_id, profiler):
+        with self._lock:
+            path = self._path("{}.{}.trace.json".format(model_id.replace(":", "-"), len(self.files)))
+        profiler.export_chrome_trace(path)
+
+    def save(self):
+        """Writes the cProfile statistics of the request."""
+        with self._lock:
+            if self._stats is not None:
+                self._stats.dump_stats(self._path("pstats"))
+
+
+class ProfileStore:
+    """
+    The directory of the profiles, holding at most max_bytes of them:
+    the oldest files are deleted first.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory) if os.path.isdir(self.directory) else ():
+            if entry.is_file():
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.name, st.st_size))
+        return sorted(entries)
+
+    def list(self):
+        """Returns the profile files, the most recent first."""
+        return [{"name": name, "size": size, "mtime": mtime} for mtime, name, size in reversed(self._entries())]
+
+    def path(self, name):
+        """Returns the path of a profile file, or None if it does not exist."""
+        path = os.path.join(self.directory, os.path.basename(name))
+        return path if os.path.isfile(path) else None
+
+    def save(self, profile):
+        profile.save()
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, _, size in entries)
+            for _, name, size in entries:
+                if total <= self._max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class Profiler:
+    """Decides which requests are profiled."""
+
+    def __init__(self, store, token=None, max_requests=100):
+        self.store = store
+        self._token = token
+        self._max_requests = max_requests
+        self._armed = 0
+        self._lock = threading.Lock()
+        self._handler_busy = False
+
+    @property
+    def armed(self):
+        return self._armed
+
+    def authorized(self, headers):
+        """Tells whether the X-Profile header carries the token. Without a
+        configured token, no request is authorized."""
+        value = headers.get("x-profile")
+        return value is not None and self._token is not None and hmac.compare_digest(
+            value.encode(), self._token.encode()
+        )
+
+    def arm(self, requests):
+        """Profiles the next requests, at most max_requests. Returns their number."""
+        with self._lock:
+            self._armed = max(0, min(requests, self._max_requests))
+            return self._armed
+
+    def should_profile(self, headers):
+        if self.authorized(headers):
+            return True
+        with self._lock:
+            if self._armed > 0:
+                self._armed -= 1
+                return True
+        return False
+
+    async def serve(self, profile, call):
+        """Awaits the handler call() of a profiled request."""
+        token = _current.set(profile)
+        profiler = None
+        if not self._handler_busy:
+            profiler = cProfile.Profile()
+            self._handler_busy = _enable(profiler)
+            if not self._handler_busy:
+                profiler = None
+        try:
+            await call()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profile.add_stats(profiler)
+                self._handler_busy = False
+            _current.reset(token)
+            await run_in_threadpool(self.store.save, profile)
+            logging.info("Profile {} of {} saved: {}".format(profile.id, profile.request_name, profile.files))
+
+
+@contextmanager
+def forward_profiler(model_id, profile=None):
+    """Records the forward pass run in the block with torch.profiler, if it
+    is for a profiled request (the current one by default)."""
+    profile = profile or current_profile()
+    if profile is None or not _trace_lock.acquire(blocking=False):
+        yield
+        return
+    try:
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True) as prof:
+            yield
+        profile.add_trace(model_id, prof)
+    finally:
+        _trace_lock.release()
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling the requests chosen by the profiler."""
+
+    def __init__(self, app, profiler, excluded_prefix="/admin/"):
+        self.app = app
+        self.profiler = profiler
+        self.excluded_prefix = excluded_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.excluded_prefix):
+            return await self.app(scope, receive, send)
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        if not self.profiler.should_profile(headers):
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(self.profiler.store.directory, "{} {}".format(scope["method"], scope["path"]))
+
+        async def send_profile_id(message):
+            if message["type"] == "http.response.start":
+                message = dict(message, headers=list(message.get("headers", [])) + [
+                    (b"x-profile-id", profile.id.encode())
+                ])
+            await send(message)
+
+        await self.profiler.serve(profile, lambda: self.app(scope, receive, send_profile_id))
+
+
+profiler = Profiler(
+    ProfileStore(conf.profiling_dir, conf.profiling_max_bytes), conf.profiling_token, conf.profiling_max_requests
+)
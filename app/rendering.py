@@ -0,0 +1,139 @@
+"""
+Rendering functions run by the render pool. They take and return only
+picklable values, so that they can run in worker processes too. Plots use
+the object-oriented Figure API with the Agg canvas instead of pyplot, whose
+global state is not safe with concurrent requests.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_svg import FigureCanvasSVG
+from matplotlib.figure import Figure
+
+from app.image_transform import transform_wrapper
+from app.metrics import stage_timer
+from app.ml.classification_utils import fetch_image
+
+PLOT_FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+# format name -> (PIL format, media type) of the transformed images
+IMAGE_FORMATS = {"jpeg": ("JPEG", "image/jpeg"), "png": ("PNG", "image/png"), "webp": ("WEBP", "image/webp")}
+_CANVASES = {"png": FigureCanvasAgg, "svg": FigureCanvasSVG}
+
+
+class RenderCache:
+    """Thread-safe LRU cache of rendered bytes, holding at most max_bytes."""
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self._max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = data
+            self._bytes += len(data)
+            while self._bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+
+def plot_key(classification_scores, fmt):
+    """Returns the hash identifying the plot of the scores in the given format,
+    which is also used as its ETag."""
+    canonical = json.dumps([fmt, classification_scores], separators=(",", ":"))
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def render_scores_plot(classification_scores, fmt="png"):
+    """Draws the classification scores, a list of [label, score] pairs,
+    as a horizontal bar chart and returns it as PNG or SVG bytes."""
+    with stage_timer("render_plot"):
+        return _render_scores_plot(classification_scores, fmt)
+
+
+def _render_scores_plot(classification_scores, fmt):
+    categories = [item[0] for item in classification_scores]
+    values = [item[1] for item in classification_scores]
+
+    sorted_indices = sorted(range(len(values)), key=lambda k: values[k], reverse=False)
+    categories = [categories[i] for i in sorted_indices]
+    values = [values[i] for i in sorted_indices]
+
+    fig = Figure(figsize=(10, len(categories) * 0.5))
+    _CANVASES[fmt](fig)
+    ax = fig.add_subplot()
+    ax.barh(categories, values, color=['#3F0355', '#06216C', '#795703', '#750014', '#1A4A04'])
+    ax.set_title('Output Scores')
+    ax.margins(y=0.01)
+    fig.tight_layout()
+    ax.grid(True, linewidth=0.1)
+
+    image_stream = BytesIO()
+    fig.savefig(image_stream, format=fmt)
+    return image_stream.getvalue()
+
+
+def canonical_transforms(transforms):
+    """Returns the transformations as a dictionary in the order of the
+    wrapper, with float values and without those left at their default.
+    Raises ValueError for unknown transformations or out of range values."""
+    available = transform_wrapper.transforms
+    unknown = set(transforms) - set(available)
+    if unknown:
+        raise ValueError("Unknown transformations {}".format(sorted(unknown)))
+    canonical = {}
+    for name, spec in available.items():
+        if transforms.get(name) is None:
+            continue
+        value = float(transforms[name])
+        if not spec["min"] <= value <= spec["max"]:
+            raise ValueError("{} must be between {} and {}".format(name, spec["min"], spec["max"]))
+        if value != spec["default"]:
+            canonical[name] = value
+    return canonical
+
+
+def transformed_image_key(digest, transforms, fmt, quality):
+    """Returns the hash identifying the transformed image, which is also used
+    as its ETag. digest is the one of the source image, and transforms must
+    be canonical."""
+    canonical = json.dumps([digest, transforms, fmt, quality], separators=(",", ":"))
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def render_transformed_image(image_id, transforms, fmt="jpeg", quality=75):
+    """Applies the transformations to the image image_id and returns the
+    result encoded in the given format. quality is ignored by PNG."""
+    source = fetch_image(image_id)
+    try:
+        with stage_timer("decode"):
+            img = source.convert("RGB")
+    finally:
+        source.close()
+    with stage_timer("transform"):
+        img = transform_wrapper.apply_transform(img, transforms)
+    buff = BytesIO()
+    pil_format = IMAGE_FORMATS[fmt][0]
+    with stage_timer("encode"):
+        if pil_format == "PNG":
+            img.save(buff, format=pil_format)
+        else:
+            img.save(buff, format=pil_format, quality=quality)
+    return buff.getvalue()
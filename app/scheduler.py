@@ -0,0 +1,211 @@
+"""
+Admission control in front of the classifications. Each model runs at most
+a configured number of requests at the same time; the others wait in a
+queue served by priority class (interactive requests before the batch
+ones) and then by earliest deadline. Every request has a deadline: it is
+shed when its queue is full (429), or when it can no longer finish before
+the deadline, given the recent service time of its model (503), so that
+no compute is spent on answers the client will not wait for.
+
+The service time of a model is the time spent running it, reported with
+app.metrics.model_timer: the loading of the models, the results found in
+the caches and the failed requests are not counted. The estimate halves
+every estimate_half_life seconds without a new measure, so that a model
+whose estimate exceeds the deadlines admits requests again.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from collections import Counter
+
+from app.config import Configuration
+from app.executors import inference_pool
+from app.metrics import Counter as CounterMetric, Gauge, ModelTime, metrics
+
+conf = Configuration()
+
+PRIORITIES = ("interactive", "batch")
+
+
+class RequestShedError(Exception):
+    """Raised when the scheduler refuses a request. status_code is 429 when
+    the queue is full, 503 when the deadline cannot be met."""
+
+    def __init__(self, message, status_code, retry_after, reason):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _ModelQueue:
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.waiting = []  # heap of (priority, deadline, sequence, future)
+        self.service_time = None  # moving average, in seconds
+        self.measured_at = None  # time.monotonic() of the last measure
+
+
+class Scheduler:
+    """
+    Runs the functions of the requests in the pool, one queue per model.
+    Input: limits, the maximum number of running requests of each model
+    (default_limit for the others), looked up by model id then by base
+    model; queue_limits, the maximum number of waiting requests of each
+    priority class; estimate_half_life, in seconds.
+    It must be used from a single event loop.
+    """
+
+    # weight of the last request in the moving average of the service time
+    _SMOOTHING = 0.2
+
+    def __init__(self, pool, limits, default_limit, queue_limits, retry_after=1, estimate_half_life=30.0):
+        self._pool = pool
+        self._limits = limits
+        self._default_limit = default_limit
+        self._queue_limits = queue_limits
+        self._retry_after = retry_after
+        self._half_life = estimate_half_life
+        self._models = {}
+        self._waiting = Counter()  # priority -> waiting requests
+        self._sequence = itertools.count()
+        self.shed = Counter()  # (model_id, priority, reason) -> shed requests
+
+    def _queue(self, model_id):
+        queue = self._models.get(model_id)
+        if queue is None:
+            base = model_id.split(":")[0]
+            limit = self._limits.get(model_id, self._limits.get(base, self._default_limit))
+            queue = self._models[model_id] = _ModelQueue(limit)
+        return queue
+
+    def deadline(self, priority, timeout_s=None):
+        """Returns the deadline of a request of the priority class starting
+        now, with the timeout requested by the client if any."""
+        default = conf.request_timeouts_s[priority]
+        return time.monotonic() + (default if timeout_s is None else min(timeout_s, default))
+
+    def stats(self):
+        """Returns the queue depth, the running requests and the shed counts."""
+        models = {}
+        for model_id, queue in self._models.items():
+            depth = Counter(entry[0] for entry in queue.waiting)
+            models[model_id] = {
+                "running": queue.running,
+                "limit": queue.limit,
+                "queued": {p: depth[i] for i, p in enumerate(PRIORITIES)},
+                "service_time_s": self._service_time(queue),
+            }
+        shed = [{"model": m, "priority": p, "reason": r, "count": n} for (m, p, r), n in self.shed.items()]
+        return {"models": models, "shed": shed}
+
+    def collect_metrics(self):
+        """Returns the state of the queues as Prometheus metrics, by model."""
+        running = Gauge("scheduler_running_requests", "Requests running, by model.", ("model",))
+        queued = Gauge("scheduler_queued_requests", "Requests waiting for a slot.", ("model", "priority"))
+        service_time = Gauge(
+            "scheduler_service_time_seconds", "Estimated service time, by model.", ("model",)
+        )
+        shed = CounterMetric("scheduler_shed_requests_total", "Requests refused.", ("model", "priority", "reason"))
+        for model_id, queue in self._models.items():
+            running.set((model_id,), queue.running)
+            for rank, priority in enumerate(PRIORITIES):
+                queued.set((model_id, priority), sum(1 for entry in queue.waiting if entry[0] == rank))
+            if queue.service_time is not None:
+                service_time.set((model_id,), self._service_time(queue))
+        for labels, count in self.shed.items():
+            shed.set(labels, count)
+        return [running, queued, service_time, shed]
+
+    def _shed(self, model_id, priority, reason, status_code):
+        self.shed[(model_id, priority, reason)] += 1
+        messages = {
+            "queue_full": "Too many {} requests are waiting".format(priority),
+            "deadline": "The request cannot be completed before its deadline",
+        }
+        return RequestShedError(messages[reason], status_code, self._retry_after, reason)
+
+    def _service_time(self, queue):
+        """Returns the estimated service time of the model, decayed since its last measure."""
+        if queue.service_time is None:
+            return 0.0
+        return queue.service_time * 0.5 ** ((time.monotonic() - queue.measured_at) / self._half_life)
+
+    def _measure(self, queue, seconds):
+        estimate = self._service_time(queue)
+        queue.service_time = seconds if queue.service_time is None else (
+            self._SMOOTHING * seconds + (1 - self._SMOOTHING) * estimate)
+        queue.measured_at = time.monotonic()
+
+    def _can_finish(self, queue, deadline):
+        return time.monotonic() + self._service_time(queue) <= deadline
+
+    async def run(self, model_id, priority, deadline, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) for a request of model_id once the model
+        has a free slot, and returns its result. Raises RequestShedError if
+        the request is shed."""
+        queue = self._queue(model_id)
+        rank = PRIORITIES.index(priority)
+        if not self._can_finish(queue, deadline):
+            raise self._shed(model_id, priority, "deadline", 503)
+        if queue.running >= queue.limit or queue.waiting:
+            if self._waiting[priority] >= self._queue_limits[priority]:
+                raise self._shed(model_id, priority, "queue_full", 429)
+            future = asyncio.get_running_loop().create_future()
+            entry = (rank, deadline, next(self._sequence), future)
+            heapq.heappush(queue.waiting, entry)
+            self._waiting[priority] += 1
+            try:
+                # a slot is handed over by the request which releases it
+                await asyncio.wait_for(future, max(deadline - time.monotonic(), 0))
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                # the slot may have been handed over at the same time
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    self._release(model_id, queue)
+                if isinstance(e, asyncio.TimeoutError):
+                    raise self._shed(model_id, priority, "deadline", 503)
+                raise
+            finally:
+                # _release pops the entries, including the cancelled ones
+                if entry in queue.waiting:
+                    queue.waiting.remove(entry)
+                    heapq.heapify(queue.waiting)
+                self._waiting[priority] -= 1
+        else:
+            queue.running += 1
+
+        try:
+            with ModelTime() as work:
+                result = await self._pool.run(fn, *args, **kwargs)
+            if work.seconds is not None:
+                self._measure(queue, work.seconds)
+            return result
+        finally:
+            self._release(model_id, queue)
+
+    def _release(self, model_id, queue):
+        """Hands the slot over to the next waiting request which can still
+        finish in time, shedding the expired ones."""
+        while queue.waiting:
+            rank, deadline, _, future = heapq.heappop(queue.waiting)
+            if future.done():
+                continue
+            if not self._can_finish(queue, deadline):
+                future.set_exception(self._shed(model_id, PRIORITIES[rank], "deadline", 503))
+                continue
+            future.set_result(None)
+            return
+        queue.running -= 1
+
+
+scheduler = Scheduler(
+    inference_pool,
+    conf.model_concurrency,
+    conf.default_model_concurrency,
+    conf.scheduler_queue_limits,
+    conf.retry_after_s,
+    conf.scheduler_estimate_half_life_s,
+)
+metrics.collector(scheduler.collect_metrics)
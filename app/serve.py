@@ -0,0 +1,98 @@
+"""
+Runs the web server in several worker processes which share the weights
+of the models. The models are loaded once in the parent process, which
+then forks the workers: the weights are shared copy-on-write, and as
+inference never writes them, each extra worker only adds its own
+activations, caches and threads. Models loaded from snapshots are also
+mapped from the same files, so their pages are shared with any other
+process using the snapshots.
+
+    python -m app.serve [--workers N] [--host 0.0.0.0] [--port 8000]
+"""
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+
+import torch
+import uvicorn
+
+from app.config import Configuration
+from app.ml.classification_utils import registry
+
+conf = Configuration()
+
+
+def _run_worker(sock, workers):
+    """Serves the application on the socket inherited from the parent."""
+    if conf.torch_num_threads is None:
+        # the cores are split among the workers instead of being oversubscribed
+        torch.set_num_threads(max(1, os.cpu_count() // workers))
+    config = uvicorn.Config("main:app", log_level="info")
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def _fork_worker(sock, workers):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            _run_worker(sock, workers)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def serve(host="127.0.0.1", port=8000, workers=None):
+    workers = workers or conf.server_workers
+    # the models are loaded before forking, so that the workers share them
+    registry.warm_up(conf.shared_models)
+    import main  # noqa: F401, imported once for all the workers
+    # the objects created so far are never collected, so the collector does
+    # not write to their pages, which stay shared with the workers
+    gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    children = set()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for _ in range(workers):
+        children.add(_fork_worker(sock, workers))
+    logging.info("Serving on http://{}:{} with {} workers".format(host, port, workers))
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            logging.warning("Worker {} exited with status {}, starting a new one".format(pid, status))
+            children.add(_fork_worker(sock, workers))
+    sock.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, help="worker processes, server_workers of the configuration by default")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
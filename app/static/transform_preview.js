@@ -0,0 +1,21 @@
+$(document).ready(function () {
+    /* Shows the transformed image while the sliders are moved. The images are
+       requested by URL, so that the server and the browser can cache them. */
+    var form = $('form');
+    var preview = $('#transformPreview');
+
+    function updatePreview() {
+        var params = {};
+        form.find('input[type=range]').each(function () {
+            if (parseFloat(this.value) !== parseFloat(this.defaultValue)) {
+                params[this.name] = this.value;
+            }
+        });
+        var image_id = form.find('select[name=image_id]').val();
+        var query = $.param(params);
+        preview.attr('src', 'transformed_image/' + encodeURIComponent(image_id) + (query ? '?' + query : ''));
+    }
+
+    form.on('change', 'select, input[type=range]', updatePreview);
+    updatePreview();
+});
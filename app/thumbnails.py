@@ -0,0 +1,76 @@
+"""
+Fixed-size JPEG renditions of the catalog images, so that the pages do
+not ship the full resolution files. Thumbnails are stored on disk under
+<thumbnail_dir>/<size>/<image_id>, generated lazily on the first request
+or in advance, for the whole catalog, with prepare_thumbnails.py. A
+thumbnail is generated again when its catalog image is modified.
+"""
+import os
+import threading
+from urllib.parse import quote
+
+from PIL import Image
+
+from app.config import Configuration
+
+conf = Configuration()
+
+
+def thumbnail_size(size):
+    """Returns the smallest configured size that is at least size, or the
+    largest configured size."""
+    sizes = sorted(conf.thumbnail_sizes)
+    return next((s for s in sizes if s >= size), sizes[-1])
+
+
+def thumbnail_url(image_id, size):
+    """Returns the URL of the rendition of the image fitting in a box of
+    size x size pixels. It is available to the templates. The URL carries
+    the modification time of the catalog image, so that it changes with
+    the image and the browsers can cache it for long."""
+    url = "/thumbnails/{}/{}".format(thumbnail_size(size), quote(image_id))
+    try:
+        return "{}?v={}".format(url, os.stat(os.path.join(conf.image_folder_path, image_id)).st_mtime_ns)
+    except FileNotFoundError:
+        return url
+
+
+def thumbnail_path(image_id, size):
+    return os.path.join(conf.thumbnail_dir, str(size), image_id)
+
+
+def is_up_to_date(image_id, size):
+    """Tells whether the thumbnail exists and is newer than its catalog image."""
+    try:
+        source_mtime = os.stat(os.path.join(conf.image_folder_path, image_id)).st_mtime_ns
+        return os.stat(thumbnail_path(image_id, size)).st_mtime_ns >= source_mtime
+    except FileNotFoundError:
+        return False
+
+
+def render_thumbnail(image_id, size, quality=None):
+    """Writes the thumbnail of the catalog image fitting in a box of
+    size x size pixels and returns its path. The file is replaced
+    atomically, so it can be served while it is generated again."""
+    path = thumbnail_path(image_id, size)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with Image.open(os.path.join(conf.image_folder_path, image_id)) as img:
+        # the JPEG is decoded directly at a reduced scale, at least twice the size
+        img.draft("RGB", (2 * size, 2 * size))
+        img = img.convert("RGB")
+        img.thumbnail((size, size), Image.LANCZOS)
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    img.save(tmp_path, format="JPEG", quality=quality or conf.thumbnail_quality, optimize=True, progressive=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def render_thumbnails(image_id, sizes):
+    """Writes the missing or outdated thumbnails of the image, and returns
+    how many were written."""
+    written = 0
+    for size in sizes:
+        if not is_up_to_date(image_id, size):
+            render_thumbnail(image_id, size)
+            written += 1
+    return written
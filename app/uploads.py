@@ -0,0 +1,118 @@
+"""
+Handling of the uploaded images: a middleware capping the size of the
+request bodies while they are received, and a short-lived store from
+which the uploaded images are served by URL instead of being inlined
+in the pages as base64.
+"""
+import os
+import re
+import threading
+import time
+
+from fastapi import HTTPException
+
+
+class BodySizeLimitMiddleware:
+    """
+    ASGI middleware answering 413 to the requests whose body is larger than
+    the limit of their path (default_limit if the path is not in limits).
+    The body is counted while it is received, so the limit holds for
+    chunked requests too.
+    """
+
+    def __init__(self, app, default_limit, limits=None):
+        self.app = app
+        self.default_limit = default_limit
+        self.limits = limits or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        limit = self.limits.get(scope["path"], self.default_limit)
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            await send({"type": "http.response.start", "status": 413,
+                        "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+            await send({"type": "http.response.body", "body": b"Request body too large"})
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail="Request body too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+class EphemeralStore:
+    """
+    Stores uploaded images in directory for ttl_s seconds, keeping at most
+    max_bytes of them. Images are stored under their digest, so identical
+    uploads share the same file. The directory can be shared by several
+    server processes.
+    """
+
+    _TOKEN = re.compile(r"^[0-9a-f]{16,128}$")
+
+    def __init__(self, directory, max_bytes, ttl_s):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._ttl = ttl_s
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, data, digest):
+        """Stores the image bytes and returns the token to retrieve them."""
+        path = os.path.join(self._directory, digest)
+        if os.path.exists(path):
+            # refreshes the expiry time
+            os.utime(path)
+        else:
+            tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self._prune()
+        return digest
+
+    def path(self, token):
+        """Returns the path of the stored image, or None if it has expired
+        or the token is not valid."""
+        if not self._TOKEN.match(token):
+            return None
+        path = os.path.join(self._directory, token)
+        try:
+            if time.time() - os.path.getmtime(path) > self._ttl:
+                return None
+        except OSError:
+            return None
+        return path
+
+    def _prune(self):
+        """Removes the expired images and, if the store is still too large,
+        the oldest ones. It runs at most once per second."""
+        now = time.time()
+        with self._lock:
+            if now - self._last_prune < 1:
+                return
+            self._last_prune = now
+        with os.scandir(self._directory) as it:
+            entries = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in it if self._TOKEN.match(e.name)]
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if now - mtime <= self._ttl and total <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
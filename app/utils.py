@@ -2,14 +2,13 @@ import os
 
 from fastapi import UploadFile
 
+from app.catalog import Catalog
 from app.config import Configuration
 
 conf = Configuration()
+catalog = Catalog(conf.image_folder_path, os.path.join(conf.image_folder_path, "imagenet_labels.json"))
 
 
 def list_images():
     """Returns the list of available images."""
-    img_names = filter(
-        lambda x: x.endswith(".JPEG"), os.listdir(conf.image_folder_path)
-    )
-    return list(img_names)
+    return catalog.images()
@@ -0,0 +1,26 @@
+"""
+Starts an RQ worker serving the classification jobs. The worker does not
+fork for each job, so the models stay resident between jobs.
+
+    python -m app.worker
+"""
+import logging
+
+from rq import SimpleWorker
+
+from app.config import Configuration
+from app.jobs import get_connection
+from app.ml.classification_utils import registry
+
+conf = Configuration()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    registry.warm_up(conf.warm_up_models)
+    worker = SimpleWorker([conf.job_queue_name], connection=get_connection())
+    worker.work()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Measures the classification throughput with and without micro-batching
+when many clients classify the catalog images with the same model. Each
+image is decoded, preprocessed and run through the model: the caches of
+the results, the score index, the image shards and the tensor cache are
+bypassed, so that every classification does its work.
+
+    python -m benchmarks.batching --model resnet18 --clients 16 32 64
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config import Configuration
+from app.ml import classification_utils
+from app.ml.inference_engine import InferenceEngine
+from app.utils import list_images
+
+
+def classify(model_id, img_id):
+    """Classifies a catalog image without any cache."""
+    img = classification_utils.fetch_image(img_id)
+    try:
+        tensor = classification_utils.preprocess(img, model_id)
+    finally:
+        img.close()
+    return classification_utils.run_model(model_id, tensor.unsqueeze(0))
+
+
+def run(model_id, images, clients, engine):
+    """Classifies every image with clients concurrent threads and returns
+    the throughput in images per second."""
+    classification_utils.engine = engine
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(lambda img_id: classify(model_id, img_id), images))
+    elapsed = time.perf_counter() - start
+    return len(images) / elapsed
+
+
+def main():
+    conf = Configuration()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=conf.models[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[16, 32, 64])
+    parser.add_argument("--images", type=int, default=1000, help="number of catalog images to classify")
+    parser.add_argument("--max-batch-size", type=int, default=conf.max_batch_size)
+    parser.add_argument("--max-wait-ms", type=float, default=conf.max_batch_wait_ms)
+    args = parser.parse_args()
+
+    images = list_images()[:args.images]
+    classification_utils.registry.warm_up([args.model])
+    batching = InferenceEngine(
+        classification_utils.registry.get, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms
+    )
+    try:
+        for clients in args.clients:
+            unbatched = run(args.model, images, clients, None)
+            batched = run(args.model, images, clients, batching)
+            print(json.dumps({
+                "model": args.model,
+                "images": len(images),
+                "clients": clients,
+                "unbatched_images_per_s": round(unbatched, 2),
+                "batched_images_per_s": round(batched, 2),
+                "speedup": round(batched / unbatched, 2),
+            }))
+    finally:
+        batching.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Measures the cold start of the models: each measurement runs in a fresh
+interpreter, which imports the service, loads one model and classifies
+one catalog image twice. It compares the models built by torchvision with
+the snapshots written by prepare_models.py.
+
+    python -m benchmarks.cold_start --models resnet18 vgg16 --repeat 3 --output cold_start.json
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+from app.config import Configuration
+
+# run by the child interpreters: argv is the model id and 1 to use the snapshots
+_CHILD = """
+import json, resource, sys, time
+start = time.perf_counter()
+from app.config import Configuration
+Configuration.model_snapshots_enabled = sys.argv[2] == "1"
+import torch
+from app.ml.classification_utils import fetch_image, preprocess, registry
+from app.utils import list_images
+imported = time.perf_counter()
+model = registry.get(sys.argv[1])
+loaded = time.perf_counter()
+img = fetch_image(list_images()[0])
+batch = preprocess(img, sys.argv[1]).unsqueeze(0)
+timings = []
+for _ in range(2):
+    t = time.perf_counter()
+    with torch.inference_mode():
+        model(batch)
+    timings.append(time.perf_counter() - t)
+print(json.dumps({
+    "import_s": imported - start,
+    "load_s": loaded - imported,
+    "first_request_s": timings[0],
+    "second_request_s": timings[1],
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+"""
+
+
+def measure(model_id, snapshots):
+    out = subprocess.run(
+        [sys.executable, "-c", _CHILD, model_id, "1" if snapshots else "0"],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", default=list(Configuration.models))
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the median is reported")
+    parser.add_argument("--output", help="JSON file where the results are written")
+    args = parser.parse_args()
+
+    results = []
+    for model_id in args.models:
+        for snapshots in (False, True):
+            runs = [measure(model_id, snapshots) for _ in range(args.repeat)]
+            result = {"model": model_id, "snapshot": snapshots}
+            result.update({key: round(statistics.median(r[key] for r in runs), 4) for key in runs[0]})
+            results.append(result)
+            print(json.dumps(result))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
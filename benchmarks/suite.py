@@ -0,0 +1,355 @@
+"""
+Benchmark suite of the service. It drives the application in-process
+through an ASGI client, at several concurrency levels, for every endpoint
+and every model, and times the stages of the requests on their own. The
+images are generated, so that it needs neither the catalog nor the network.
+By default the caches of the results are disabled, so that every request
+does its work; --caches keeps them as configured.
+
+The results (throughput, p50/p95/p99 latency and peak RSS) are written as
+JSON, and can be compared with a baseline written by a previous run: the
+entries whose p95 latency grew, or whose throughput fell, by more than the
+tolerance are reported as regressions, and the exit status is 1.
+
+    python -m benchmarks.suite --concurrency 1 8 --output baseline.json
+    python -m benchmarks.suite --concurrency 1 8 --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from app.config import Configuration
+
+# sizes of the generated images, like those of the catalog and of the uploaded photos
+IMAGE_SIZES = ((500, 375), (640, 480), (375, 500), (1024, 768), (2048, 1536))
+
+
+def generate_images(directory, count, seed=0):
+    """Writes count JPEG images of smooth random colors, with noise, and
+    the labels file of the catalog to directory. Returns the image ids."""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    image_ids = []
+    for i in range(count):
+        image_id = "bench_{:05d}.JPEG".format(i)
+        path = os.path.join(directory, image_id)
+        if not os.path.exists(path):
+            width, height = IMAGE_SIZES[i % len(IMAGE_SIZES)]
+            colors = Image.fromarray(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)).resize((width, height),
+                                                                                             Image.BICUBIC)
+            noise = rng.normal(0, 12, (height, width, 3))
+            pixels = np.clip(np.asarray(colors, dtype=np.float32) + noise, 0, 255).astype(np.uint8)
+            Image.fromarray(pixels).save(path, quality=90)
+        image_ids.append(image_id)
+    labels_path = os.path.join(directory, "imagenet_labels.json")
+    if not os.path.exists(labels_path):
+        with open(labels_path, "w") as f:
+            json.dump(["class{}".format(i) for i in range(1000)], f)
+    return image_ids
+
+
+def configure(workdir, caches):
+    """Points the configuration to the generated images and to empty cache
+    directories. It must run before the application is imported."""
+    Configuration.image_folder_path = os.path.join(workdir, "images")
+    for name in ("histogram_index_path", "embedding_index_path", "score_index_path", "image_shard_path",
+                 "thumbnail_dir", "upload_store_dir", "result_cache_dir", "profiling_dir"):
+        setattr(Configuration, name, os.path.join(workdir, name))
+    Configuration.warm_up_models = ()
+    if not caches:
+        Configuration.score_index_enabled = False
+        Configuration.image_shards_enabled = False
+        Configuration.result_cache_backend = None
+        Configuration.result_cache_max_entries = 0
+        Configuration.tensor_cache_mb = 0
+        Configuration.plot_cache_bytes = 0
+        Configuration.transform_cache_bytes = 0
+
+
+def use_random_weights():
+    """Builds the models without their pretrained weights, which have the
+    same cost, on machines where they cannot be downloaded."""
+    from app.ml import model_registry
+
+    def load_random_model(model_id):
+        return getattr(importlib.import_module("torchvision.models"), model_id)(weights=None)
+
+    Configuration.model_snapshots_enabled = False
+    model_registry.load_torchvision_model = load_random_model
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(latencies):
+    """Returns the p50, p95 and p99 latencies in milliseconds."""
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99]) if latencies else (None,) * 3
+    return {"p50_ms": _round(p50), "p95_ms": _round(p95), "p99_ms": _round(p99)}
+
+
+def _round(value, digits=3):
+    return None if value is None else round(float(value), digits)
+
+
+# the requests of the scenarios: (per model, function returning the request for the i-th call)
+def _scenarios(images, uploads):
+    def pick(i):
+        return images[i % len(images)]
+
+    def random_transforms(i):
+        r = random.Random(i)
+        return {name: round(r.uniform(0.5, 1.5), 2) for name in ("Color", "Contrast", "Brightness", "Sharpness")}
+
+    def random_scores(i):
+        r = random.Random(i)
+        return json.dumps([["class{}".format(r.randrange(1000)), round(r.uniform(0, 100), 2)] for _ in range(5)])
+
+    return {
+        "info": (False, lambda c, i, m: c.get("/info", params={"limit": 100})),
+        "home": (False, lambda c, i, m: c.get("/")),
+        "classifications_page": (False, lambda c, i, m: c.get("/classifications")),
+        "classifications": (True, lambda c, i, m: c.post(
+            "/classifications", data={"image_id": pick(i), "model_id": m})),
+        "classifications_upload": (True, lambda c, i, m: c.post(
+            "/classifications_upload", data={"model_id": m},
+            files={"immagine": ("upload.JPEG", uploads[i % len(uploads)], "image/jpeg")})),
+        "api_classifications": (True, lambda c, i, m: c.post(
+            "/api/classifications", json={"image_ids": [pick(i), pick(i + 1)], "model_ids": [m]})),
+        "similar": (True, lambda c, i, m: c.get("/similar/" + pick(i), params={"model_id": m, "k": 10})),
+        "transform_image": (False, lambda c, i, m: c.post(
+            "/transform_image", data={"image_id": pick(i), **random_transforms(i)})),
+        "transformed_image": (False, lambda c, i, m: c.get(
+            "/transformed_image/" + pick(i), params=random_transforms(i))),
+        "download_plot": (False, lambda c, i, m: c.get(
+            "/download_plot/" + pick(i), params={"classification_scores": random_scores(i)})),
+        "histogram": (False, lambda c, i, m: c.get("/histogram/" + pick(i))),
+        "thumbnail": (False, lambda c, i, m: c.get("/thumbnails/256/" + pick(i))),
+        "metrics": (False, lambda c, i, m: c.get("/metrics")),
+    }
+
+
+async def run_scenario(client, request, model_id, concurrency, requests):
+    """Sends requests requests with concurrency clients and returns the
+    throughput, the latency percentiles and the number of errors."""
+    calls = itertools.count()
+    latencies = []
+    errors = 0
+
+    async def send_requests():
+        nonlocal errors
+        while True:
+            i = next(calls)
+            if i >= requests:
+                return
+            start = time.perf_counter()
+            try:
+                response = await request(client, i, model_id)
+                failed = response.status_code >= 400
+            except Exception:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send_requests() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {"requests": requests, "errors": errors, "throughput_rps": _round(requests / elapsed),
+            **summarize(latencies)}
+
+
+async def benchmark_endpoints(scenarios, models, concurrency_levels, requests):
+    import httpx
+    import main
+
+    results = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app), httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for name, (per_model, request) in scenarios.items():
+            for model_id in models if per_model else [None]:
+                # the first calls load the models and fill the lazy state, they are not measured
+                await run_scenario(client, request, model_id, 1, 2)
+                for concurrency in concurrency_levels:
+                    result = {"endpoint": name, "model": model_id, "concurrency": concurrency}
+                    result.update(await run_scenario(client, request, model_id, concurrency, requests))
+                    result["peak_rss_mb"] = _round(peak_rss_mb(), 1)
+                    print(json.dumps(result))
+                    results.append(result)
+    return results
+
+
+def time_stage(fn, repeat):
+    """Returns the latency percentiles of fn over repeat calls, after a first unmeasured one."""
+    fn()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def benchmark_stages(models, images, repeat):
+    """Times the stages of the requests on their own, on the first image."""
+    import torch
+    from app.image_transform import transform_wrapper
+    from app.ml import classification_utils as cu
+    from app.rendering import render_scores_plot, render_transformed_image
+    from app.utils import catalog
+
+    image_id = images[0]
+    scores = [["class{}".format(i), 50.0 / (i + 1)] for i in range(5)]
+    transforms = {"Color": 1.2, "Contrast": 1.3, "Brightness": 0.9, "Sharpness": 1.5}
+
+    def load_image():
+        with cu.fetch_image(image_id) as img:
+            img.load()
+
+    def transform():
+        with cu.fetch_image(image_id) as img:
+            transform_wrapper.apply_transform(img.convert("RGB"), transforms)
+
+    stages = [
+        ("list_images", None, lambda: catalog.search("bench_", 0, 100)),
+        ("fetch_image", None, load_image),
+        ("get_labels", None, cu.get_labels),
+        ("transform", None, transform),
+        ("render_transformed_image", None, lambda: render_transformed_image(image_id, transforms)),
+        ("render_plot", None, lambda: render_scores_plot(scores)),
+    ]
+    for model_id in models:
+        tensor = cu.preprocess_catalog_image(model_id, image_id, cu.catalog_image_digest(image_id)).unsqueeze(0)
+
+        def forward(model_id=model_id, tensor=tensor):
+            with torch.inference_mode():
+                cu.get_model(model_id)(tensor)
+
+        def preprocess(model_id=model_id):
+            with cu.fetch_image(image_id) as img:
+                cu.preprocess(img, model_id)
+
+        stages += [
+            ("preprocess", model_id, preprocess),
+            ("get_model", model_id, lambda model_id=model_id: cu.get_model(model_id)),
+            ("forward", model_id, forward),
+            ("classify", model_id, lambda model_id=model_id: cu.classify(model_id, cu.fetch_image(image_id))),
+        ]
+
+    results = []
+    for stage, model_id, fn in stages:
+        result = {"stage": stage, "model": model_id, "repeat": repeat, **time_stage(fn, repeat)}
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+def _key(entry):
+    if "stage" in entry:
+        return "stage", entry["stage"], entry["model"]
+    return "endpoint", entry["endpoint"], entry["model"], entry["concurrency"]
+
+
+def compare(results, baseline, tolerance, min_delta_ms=1.0):
+    """Returns the regressions of the results with respect to the baseline:
+    the entries whose p95 latency grew, or whose throughput fell, by more
+    than tolerance (a fraction). Latencies growing by less than min_delta_ms
+    are ignored, as the noise of the fastest stages is larger than them."""
+    reference = {_key(e): e for e in baseline["endpoints"] + baseline["stages"]}
+    regressions = []
+    for entry in results["endpoints"] + results["stages"]:
+        base = reference.get(_key(entry))
+        if base is None:
+            continue
+        for metric, worse in (("p95_ms", 1), ("throughput_rps", -1)):
+            old, new = base.get(metric), entry.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if metric == "p95_ms" and new - old < min_delta_ms:
+                continue
+            if change * worse > tolerance:
+                regressions.append({"key": list(_key(entry)), "metric": metric, "baseline": old, "value": new,
+                                    "change": _round(change)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", default=list(Configuration.models))
+    parser.add_argument("--endpoints", nargs="+", help="scenarios to run, all by default")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=64, help="requests per scenario and concurrency level")
+    parser.add_argument("--images", type=int, default=32, help="number of generated images")
+    parser.add_argument("--stage-repeat", type=int, default=20, help="calls per stage, 0 skips the stages")
+    parser.add_argument("--caches", action="store_true", help="keep the caches of the results as configured")
+    parser.add_argument("--random-weights", action="store_true", help="build the models without pretrained weights")
+    parser.add_argument("--workdir", help="directory of the generated images and caches, temporary by default")
+    parser.add_argument("--output", help="JSON file where the results are written")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown, as a fraction")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="smallest latency growth reported")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="benchmark-")
+    images = generate_images(os.path.join(workdir, "images"), args.images)
+    configure(workdir, args.caches)
+    if args.random_weights:
+        use_random_weights()
+
+    uploads = []
+    for image_id in images[:8]:
+        with open(os.path.join(workdir, "images", image_id), "rb") as f:
+            uploads.append(f.read())
+    scenarios = _scenarios(images, uploads)
+    unknown = set(args.endpoints or ()) - set(scenarios)
+    if unknown:
+        parser.error("unknown endpoints {}, choose among {}".format(sorted(unknown), list(scenarios)))
+    if args.endpoints:
+        scenarios = {name: scenarios[name] for name in args.endpoints}
+    if "similar" in scenarios:
+        from app.prepare_embeddings import prepare_embeddings
+        prepare_embeddings(args.models)
+
+    import torch
+    results = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpus": os.cpu_count(),
+            "caches": args.caches,
+            "random_weights": args.random_weights,
+            "images": args.images,
+        },
+        "endpoints": asyncio.run(benchmark_endpoints(scenarios, args.models, args.concurrency, args.requests)),
+        "stages": benchmark_stages(args.models, images, args.stage_repeat) if args.stage_repeat else [],
+    }
+    results["meta"]["peak_rss_mb"] = _round(peak_rss_mb(), 1)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            print("REGRESSION " + json.dumps(regression))
+        if regressions:
+            sys.exit(1)
+        print("No regressions with respect to {}".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
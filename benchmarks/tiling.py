@@ -0,0 +1,88 @@
+"""
+Compares the tiled classification with the central crop on the catalog
+images: latency per image, top-1 agreement of the two, and their top-1 and
+top-5 accuracy when the catalog is the ImageNet sample of prepare_images.py
+(one image per class, named after its WordNet id, so that the sorted ids
+give the class indices). The caches are not used.
+
+    python -m benchmarks.tiling --model resnet18 --images 1000 --output tiling.json
+"""
+import argparse
+import json
+import time
+
+from app.config import Configuration
+from app.ml.classification_utils import classify, classify_tiled, fetch_image, get_labels
+from app.ml.tiling import AGGREGATIONS
+from app.utils import list_images
+
+
+def true_labels(images):
+    """Returns the label of each image, or None if the catalog is not the
+    ImageNet sample (one image for each of the classes)."""
+    labels = get_labels()
+    ids = sorted({image_id.split("_")[0] for image_id in images})
+    if len(ids) != len(labels) or len(images) != len(labels):
+        return None
+    index = {wnid: i for i, wnid in enumerate(ids)}
+    return [labels[index[image_id.split("_")[0]]] for image_id in images]
+
+
+def measure(fn, model_id, images):
+    """Returns the top-5 scores of every image and the mean latency in ms."""
+    outputs = []
+    start = time.perf_counter()
+    for image_id in images:
+        outputs.append(fn(model_id, fetch_image(image_id)))
+    return outputs, (time.perf_counter() - start) * 1000 / len(images)
+
+
+def accuracy(outputs, labels, k):
+    return sum(label in [name for name, _ in output[:k]] for output, label in zip(outputs, labels)) / len(labels)
+
+
+def main():
+    conf = Configuration()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=conf.models[0])
+    parser.add_argument("--images", type=int, default=1000, help="number of catalog images to classify")
+    parser.add_argument("--aggregation", choices=AGGREGATIONS, default="max")
+    parser.add_argument("--output", help="JSON file where the results are recorded")
+    args = parser.parse_args()
+
+    all_images = list_images()
+    labels = true_labels(all_images)
+    images = all_images[:args.images]
+    labels = labels[:args.images] if labels is not None else None
+    classify(args.model, fetch_image(images[0]))  # loads the model
+
+    crop, crop_ms = measure(classify, args.model, images)
+    tiled, tiled_ms = measure(
+        lambda model_id, img: classify_tiled(model_id, img, aggregation=args.aggregation), args.model, images
+    )
+    result = {
+        "model": args.model,
+        "images": len(images),
+        "aggregation": args.aggregation,
+        "tiling_scales": list(conf.tiling_scales),
+        "tiling_overlap": conf.tiling_overlap,
+        "tiling_max_tiles": conf.tiling_max_tiles,
+        "crop_ms": round(crop_ms, 1),
+        "tiled_ms": round(tiled_ms, 1),
+        "top1_agreement": sum(a[0][0] == b[0][0] for a, b in zip(crop, tiled)) / len(images),
+    }
+    if labels is not None:
+        result.update({
+            "crop_top1": accuracy(crop, labels, 1),
+            "crop_top5": accuracy(crop, labels, 5),
+            "tiled_top1": accuracy(tiled, labels, 1),
+            "tiled_top5": accuracy(tiled, labels, 5),
+        })
+    print(json.dumps(result))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Compares optimized variants with their fp32 model on the catalog images:
+top-1 agreement, mean overlap of the top-5 classes, largest difference of
+the class probabilities and throughput. By default every variant of
+resnet18 and vgg16 is compared, the variants need not be enabled in
+Configuration.model_variants.
+
+    python -m benchmarks.variants --images 1000 --output variants.json
+    python -m benchmarks.variants --variants resnet18:int8 vgg16:int8-dynamic
+"""
+import argparse
+import json
+import time
+
+import torch
+
+from app.ml.classification_utils import fetch_image, model_loader, preprocess, registry
+from app.ml.runtime import VARIANTS, split_model_id
+from app.utils import list_images
+
+
+def load_batches(model_id, images, batch_size):
+    batches = []
+    for start in range(0, len(images), batch_size):
+        tensors = []
+        for image_id in images[start:start + batch_size]:
+            img = fetch_image(image_id)
+            tensors.append(preprocess(img, model_id))
+            img.close()
+        batches.append(torch.stack(tensors))
+    return batches
+
+
+def predict(model, batches):
+    """Returns the class probabilities of all the batches and the throughput in images per second."""
+    outputs = []
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for batch in batches:
+            outputs.append(torch.nn.functional.softmax(model(batch), dim=1))
+    elapsed = time.perf_counter() - start
+    return torch.cat(outputs), sum(len(b) for b in batches) / elapsed
+
+
+def compare(variant_id, images, batch_size):
+    base_id, _ = split_model_id(variant_id)
+    batches = load_batches(base_id, images, batch_size)
+    reference, reference_speed = predict(registry.get(base_id), batches)
+    # built here, as the variant may not be in Configuration.model_variants
+    scores, speed = predict(model_loader(variant_id).eval(), batches)
+    top5_reference = reference.topk(5, dim=1).indices
+    top5 = scores.topk(5, dim=1).indices
+    overlap = [len(set(a.tolist()) & set(b.tolist())) / 5 for a, b in zip(top5_reference, top5)]
+    return {
+        "model": variant_id,
+        "images": len(images),
+        "top1_agreement": (top5_reference[:, 0] == top5[:, 0]).float().mean().item(),
+        "top5_overlap": sum(overlap) / len(overlap),
+        "max_probability_delta": (reference - scores).abs().max().item(),
+        "fp32_images_per_s": round(reference_speed, 2),
+        "images_per_s": round(speed, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--variants", nargs="+",
+        default=["{}:{}".format(model, variant) for model in ("resnet18", "vgg16") for variant in VARIANTS],
+    )
+    parser.add_argument("--images", type=int, default=1000, help="number of catalog images to classify")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--output", help="JSON file where the results are recorded")
+    args = parser.parse_args()
+
+    images = list_images()[:args.images]
+    results = []
+    for variant_id in args.variants:
+        results.append(compare(variant_id, images, args.batch_size))
+        print(json.dumps(results[-1]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
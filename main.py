@@ -1,40 +1,112 @@
-import io
+import asyncio
 import json
+import time
+from urllib.parse import quote, urlencode
+from contextlib import asynccontextmanager
 
-import PIL
-import matplotlib.pyplot as plot
-from typing import Dict, List
+from typing import Dict, List, Optional, Union
 
 
-from PIL import Image
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 from app.config import Configuration
 from app.forms.classification_form import ClassificationForm
 from app.forms.classification_form_upload import ClassificationFormUpload
 from app.forms.transform_image_form import TransformImageForm
-from app.ml.classification_utils import classify_image, fetch_image, classify
-from app.utils import list_images
-from app.image_transform import TransformWrapper
-from io import BytesIO
-import base64
+from app.forms.batch_classification_form import BatchClassificationForm
+from app.ml.classification_utils import (
+    catalog_embedding, catalog_image_digest, classify_image, classify, classify_tiled, compute_embedding,
+    embedding_index, registry, engine,
+)
+from app.ml.tiling import AGGREGATIONS
+from app.ml.result_cache import image_digest
+from app.utils import catalog, list_images
+from app.image_transform import transform_wrapper
+from app.executors import QueueFullError, inference_pool, render_pool
+from app.rendering import (
+    IMAGE_FORMATS, PLOT_FORMATS, RenderCache, canonical_transforms, plot_key, render_scores_plot,
+    render_transformed_image, transformed_image_key,
+)
+from app.batch_classification import stream_classifications
+from app.scheduler import RequestShedError, scheduler
+from app.histogram import (
+    CHANNELS, HISTOGRAM_CHUNK, INDEX_NAME, compute_catalog_histogram, compute_catalog_histograms, histogram_cache,
+    histogram_to_dict, lookup_histogram,
+)
+from app.jobs import enqueue_classification, enqueue_upload_classification, get_job_status
+from app.uploads import BodySizeLimitMiddleware, EphemeralStore
+from app.metrics import MetricsMiddleware, TimedTemplates, metrics
+from app.profiling import ProfilingMiddleware, profiler
+from app.thumbnails import is_up_to_date, render_thumbnail, thumbnail_path, thumbnail_url
 
-app = FastAPI()
 config = Configuration()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Loads the models listed in the configuration before serving the
+    first request, so that users do not wait for them."""
+    registry.warm_up(config.warm_up_models)
+    yield
+    if engine is not None:
+        engine.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(
+    BodySizeLimitMiddleware, default_limit=config.max_request_body_bytes, limits=config.request_body_limits
+)
+if config.profiling_enabled:
+    if not config.profiling_token:
+        # anyone could profile the requests and download the profiles
+        raise RuntimeError("profiling_enabled requires a profiling_token")
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
+if config.metrics_enabled:
+    app.add_middleware(MetricsMiddleware, routes=app.routes)
+plot_cache = RenderCache(config.plot_cache_bytes)
+transform_cache = RenderCache(config.transform_cache_bytes)
+upload_store = EphemeralStore(config.upload_store_dir, config.upload_store_max_bytes, config.upload_store_ttl_s)
+
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
-templates = Jinja2Templates(directory="app/templates")
+templates = TimedTemplates(directory="app/templates")
+templates.env.globals["thumbnail_url"] = thumbnail_url
+
+
+@app.exception_handler(QueueFullError)
+def queue_full(request: Request, exc: QueueFullError):
+    """Sheds the request when the pool which should run it is full."""
+    return PlainTextResponse(
+        str(exc), status_code=503, headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+@app.exception_handler(RequestShedError)
+def request_shed(request: Request, exc: RequestShedError):
+    """Answers the requests shed by the scheduler."""
+    return PlainTextResponse(
+        str(exc), status_code=exc.status_code, headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+def request_timeout(request: Request) -> Optional[float]:
+    """Returns the time in seconds the client is willing to wait, from the
+    X-Timeout-Ms header, or None if it is not given."""
+    try:
+        return max(float(request.headers["x-timeout-ms"]), 0) / 1000
+    except (KeyError, ValueError):
+        return None
 
 
 @app.get("/info")
-def info() -> Dict[str, List[str]]:
+def info(prefix: str = "", offset: int = 0, limit: Optional[int] = None) -> Dict[str, Union[List[str], int]]:
     """Returns a dictionary with the list of models and
-    the list of available image files."""
-    list_of_images = list_images()
-    list_of_models = Configuration.models
-    data = {"models": list_of_models, "images": list_of_images}
+    the list of available image files. The images can be filtered
+    by the prefix of their name and paginated with offset and limit."""
+    total, list_of_images = catalog.search(prefix, max(offset, 0), limit)
+    list_of_models = registry.model_ids
+    data = {"models": list_of_models, "images": list_of_images, "total": total}
     return data
 
 
@@ -44,11 +116,33 @@ def home(request: Request):
     return templates.TemplateResponse("home.html", {"request": request})
 
 
+@app.get("/thumbnails/{size}/{image_id}")
+async def thumbnail(size: int, image_id: str, v: Optional[str] = None):
+    """
+    Returns the rendition of a catalog image fitting in a box of size x size pixels,
+    for one of the configured sizes. Missing thumbnails are generated in the render pool.
+    The versioned URLs (v, see thumbnail_url) are cached for long, the others briefly.
+    """
+    if size not in config.thumbnail_sizes:
+        raise HTTPException(status_code=404, detail="The size must be one of {}".format(list(config.thumbnail_sizes)))
+    if image_id not in catalog:
+        raise HTTPException(status_code=404, detail="Unknown image id")
+    if not await run_in_threadpool(is_up_to_date, image_id, size):
+        await render_pool.run(render_thumbnail, image_id, size)
+    return FileResponse(
+        thumbnail_path(image_id, size),
+        media_type="image/jpeg",
+        headers={"Cache-Control": "public, max-age={}".format(
+            config.thumbnail_max_age_s if v is not None else config.thumbnail_unversioned_max_age_s
+        )},
+    )
+
+
 @app.get("/classifications")
 def create_classify(request: Request):
     return templates.TemplateResponse(
         "classification_select.html",
-        {"request": request, "images": list_images(), "models": Configuration.models},
+        {"request": request, "images": list_images(), "models": registry.model_ids},
     )
 
 
@@ -56,9 +150,18 @@ def create_classify(request: Request):
 async def request_classification(request: Request):
     form = ClassificationForm(request)
     await form.load_data()
+    if not form.is_valid():
+        raise HTTPException(status_code=400, detail=form.errors)
     image_id = form.image_id
     model_id = form.model_id
-    classification_scores = classify_image(model_id=model_id, img_id=image_id)
+    if model_id not in registry.model_ids:
+        raise HTTPException(status_code=400, detail="Unknown model id")
+    if image_id not in catalog:
+        raise HTTPException(status_code=404, detail="Unknown image id")
+    deadline = scheduler.deadline("interactive", request_timeout(request))
+    classification_scores = await scheduler.run(
+        model_id, "interactive", deadline, classify_image, model_id, image_id
+    )
 
     return templates.TemplateResponse(
         "classification_output.html",
@@ -76,7 +179,7 @@ def create_classify_upload(request: Request):
 
     return templates.TemplateResponse(
         "classification_upload.html",
-        {"request": request, "models": Configuration.models},
+        {"request": request, "models": registry.model_ids, "aggregations": AGGREGATIONS},
     )
 
 
@@ -93,56 +196,60 @@ async def request_classification_upload(request: Request):
     if await form.is_valid():
         model_id = form.model_id
         image_id = form.image_id
+        if model_id not in registry.model_ids:
+            form.image.close()
+            raise HTTPException(status_code=400, detail="Unknown model id")
 
-        # Side note: we could use the internal .file attribute (SpooledTemporaryFile) directly (without io.BytesIO)
-        # inside form.image_file, but there is a backward-compatibility problem... In all versions prior to python 3.11
-        # it does not implement the buffer protocol, so it can't be used with base64.b64encode function.
-        # https://docs.python.org/3.11/whatsnew/3.11.html#tempfile
-        # https://stackoverflow.com/questions/47160211/why-doesnt-tempfile-spooledtemporaryfile-implement-readable-writable-seekable
-
-        # UploadFile, despite its name, is not a file-like object (it doesn't have the tell() method!),
-        # so it can't be used to directly create an Image object.
-        # We need to convert it into a file-like byte object first, like BytesIO!
-        buff = io.BytesIO()
-        await form.image_file.seek(0)
-        buff.write(await form.image_file.read())  # writes all content to buffer
-        await form.image_file.close()
-
+        # The form has already read the upload once into form.image_data and parsed the header
+        # of the image: the same buffer is hashed, decoded and stored, without further copies.
+        deadline = scheduler.deadline("interactive", request_timeout(request))
         try:
-            img = Image.open(buff)
-        except PIL.UnidentifiedImageError:
-            form.errors.append("We couldn't recognize the image you sent! Are you sure it was a JPEG image?")
-        else:
-            classification_scores = classify(model_id=model_id, img=img)
-
-            # Since this is a one-time classification we don't store the image permanently,
-            # so we need to pass the image as base64 encoded data to the classification output page.
-            image_b64 = base64.b64encode(buff.getvalue())
-            image_b64 = image_b64.decode("utf-8")
-
-            return templates.TemplateResponse(
-                "classification_output_upload.html",
-                {
-                    "request": request,
-                    "image_id": image_id,
-                    "image": image_b64,
-                    "classification_scores": json.dumps(classification_scores),
-                },
-            )
+            digest = await inference_pool.run(image_digest, form.image_data)
+            if form.tiling:
+                # large photos are classified by tiles, in one batched forward pass
+                classification_scores = await scheduler.run(
+                    model_id, "interactive", deadline, classify_tiled, model_id, form.image, digest, form.tiling
+                )
+            else:
+                classification_scores = await scheduler.run(
+                    model_id, "interactive", deadline, classify, model_id, form.image, digest
+                )
         finally:
-            buff.close()
+            # classify closes the image, unless the request was shed before
+            form.image.close()
+
+        # Since this is a one-time classification we don't store the image permanently:
+        # it is kept in the ephemeral store for a short time, and the output page links to it.
+        token = await run_in_threadpool(upload_store.put, form.image_data, digest)
 
         return templates.TemplateResponse(
-            "classification_upload.html",
-            {"request": request, "models": Configuration.models, "errors": form.errors},
+            "classification_output_upload.html",
+            {
+                "request": request,
+                "image_id": image_id,
+                "image_url": "/uploads/{}".format(token),
+                "classification_scores": json.dumps(classification_scores),
+            },
         )
 
     else:
         return templates.TemplateResponse(
             "classification_upload.html",
-            {"request": request, "models": Configuration.models, "errors":form.errors},
+            {"request": request, "models": registry.model_ids, "aggregations": AGGREGATIONS, "errors":form.errors},
         )
 
+@app.get("/uploads/{token}")
+def get_uploaded_image(token: str):
+    """Returns an image uploaded for classification, while it is in the ephemeral store."""
+    path = upload_store.path(token)
+    if path is None:
+        raise HTTPException(status_code=404, detail="The image has expired")
+    return FileResponse(
+        path, media_type="image/jpeg",
+        headers={"Cache-Control": "private, max-age={}".format(config.upload_store_ttl_s)},
+    )
+
+
 @app.get("/histogram")# ADDED
 def create_histogram(request: Request):
     """ Page in which an image can be selected for its histogram generation. """
@@ -166,6 +273,126 @@ async def request_histogram(request: Request):
         },
     )
 
+async def get_histogram(image_id: str):
+    """Returns the (4, 256) histograms of a catalog image, computing them in the render pool if needed."""
+    digest, histogram = await run_in_threadpool(lookup_histogram, image_id)
+    if histogram is None:
+        histogram = await render_pool.run(compute_catalog_histogram, image_id)
+        histogram_cache.put(INDEX_NAME, digest, histogram)
+    return histogram
+
+
+@app.get("/histogram/{image_id}")
+async def histogram_data(image_id: str, format: str = "json"):
+    """
+    Returns the histograms of the red, green, blue and luminance channels of a catalog image,
+    as JSON or, with format=binary, as a little-endian uint32 array of shape (4, 256).
+    """
+    if image_id not in catalog:
+        raise HTTPException(status_code=404, detail="Unknown image id")
+    if format not in ("json", "binary"):
+        raise HTTPException(status_code=400, detail="The format must be json or binary")
+    histogram = await get_histogram(image_id)
+    headers = {"Cache-Control": "public, max-age={}".format(config.plot_max_age_s)}
+    if format == "binary":
+        headers["X-Histogram-Channels"] = ",".join(CHANNELS)
+        return Response(histogram.astype("<u4").tobytes(), media_type="application/octet-stream", headers=headers)
+    return JSONResponse({"image_id": image_id, **histogram_to_dict(histogram)}, headers=headers)
+
+
+@app.post("/api/histograms")
+async def histograms_data(request: Request):
+    """
+    Returns the histograms of many catalog images at once. The body is a JSON object
+    {"image_ids": [...]}, and the result maps each image id to its histograms.
+    """
+    try:
+        image_ids = (await request.json())["image_ids"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="The body must be a JSON object with a list of image_ids")
+    if not isinstance(image_ids, list) or len(image_ids) > config.histogram_batch_max_images:
+        raise HTTPException(
+            status_code=400, detail="image_ids must be a list of at most {} ids".format(config.histogram_batch_max_images)
+        )
+    unknown_images = [i for i in image_ids if not isinstance(i, str) or i not in catalog]
+    if unknown_images:
+        raise HTTPException(status_code=400, detail={"unknown_images": unknown_images})
+    found = await run_in_threadpool(lambda: [lookup_histogram(i) for i in image_ids])
+    histograms = {i: h for i, (_, h) in zip(image_ids, found) if h is not None}
+    digests = {i: digest for i, (digest, _) in zip(image_ids, found)}
+
+    # the missing histograms are computed in chunks, so that a batch takes few tasks of the pool
+    missing = list(dict.fromkeys(i for i in image_ids if i not in histograms))
+    chunks = [missing[k:k + HISTOGRAM_CHUNK] for k in range(0, len(missing), HISTOGRAM_CHUNK)]
+    for chunk, computed in zip(chunks, await asyncio.gather(
+            *(render_pool.run(compute_catalog_histograms, chunk) for chunk in chunks))):
+        for image_id, histogram in zip(chunk, computed):
+            histogram_cache.put(INDEX_NAME, digests[image_id], histogram)
+            histograms[image_id] = histogram
+    return {"histograms": {i: histogram_to_dict(histograms[i]) for i in image_ids}}
+
+
+def embeddings_not_computed(model_id: str):
+    return HTTPException(status_code=404, detail="The embeddings of {} have not been computed".format(model_id))
+
+
+async def check_embeddings(model_id: str):
+    """Raises a 404 if the catalog has no embeddings of the model, before any embedding is computed."""
+    if not await run_in_threadpool(embedding_index.has_embeddings, model_id):
+        raise embeddings_not_computed(model_id)
+
+
+async def similar_images(model_id: str, vector, k: int, exclude: Optional[str] = None):
+    """Returns the response with the k catalog images most similar to the embedding."""
+    results = await run_in_threadpool(embedding_index.search, model_id, vector, k, exclude)
+    if results is None:
+        # removed since check_embeddings
+        raise embeddings_not_computed(model_id)
+    return {"model_id": model_id, "results": [{"image_id": i, "score": score} for i, score in results]}
+
+
+def check_similar_params(model_id: str, k: int):
+    if model_id not in config.models:
+        raise HTTPException(status_code=400, detail="The model must be one of {}".format(list(config.models)))
+    if not 1 <= k <= config.similar_max_k:
+        raise HTTPException(status_code=400, detail="k must be between 1 and {}".format(config.similar_max_k))
+
+
+@app.get("/similar/{image_id}")
+async def similar_to_catalog_image(request: Request, image_id: str, model_id: str = "resnet18", k: int = 10):
+    """
+    Returns the k catalog images most similar to a catalog image, by cosine similarity of
+    the embeddings of the model, computed by prepare_embeddings.py.
+    """
+    check_similar_params(model_id, k)
+    if image_id not in catalog:
+        raise HTTPException(status_code=404, detail="Unknown image id")
+    await check_embeddings(model_id)
+    deadline = scheduler.deadline("interactive", request_timeout(request))
+    vector = await scheduler.run(model_id, "interactive", deadline, catalog_embedding, model_id, image_id)
+    return await similar_images(model_id, vector, k, exclude=image_id)
+
+
+@app.post("/similar")
+async def similar_to_upload(request: Request, k: int = 10):
+    """
+    Returns the k catalog images most similar to an uploaded JPEG image, sent as a form
+    with the same fields as /classifications_upload.
+    """
+    form = ClassificationFormUpload(request)
+    await form.load_data()
+    if not await form.is_valid():
+        raise HTTPException(status_code=400, detail=form.errors)
+    try:
+        check_similar_params(form.model_id, k)
+        await check_embeddings(form.model_id)
+        deadline = scheduler.deadline("interactive", request_timeout(request))
+        vector = await scheduler.run(form.model_id, "interactive", deadline, compute_embedding, form.model_id, form.image)
+    finally:
+        form.image.close()
+    return await similar_images(form.model_id, vector, k)
+
+
 @app.get("/download_results/{image_id}")
 def download_results(classification_scores: str):
     """
@@ -187,34 +414,38 @@ def download_results(classification_scores: str):
     )
 
 
+def etag_matches(request: Request, etag: str) -> bool:
+    """Tells whether the ETag is one of those in the If-None-Match header of the request."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
+
+
 @app.get("/download_plot/{image_id}")
-async def download_plot(classification_scores: str):
+async def download_plot(request: Request, classification_scores: str, format: str = "png"):
     """
-    Creates a graph based on the scores and returns it as a downloadable PNG image using a StreamingResponse.
+    Creates a graph based on the scores and returns it as a downloadable PNG or SVG image.
+    Rendered graphs are cached, and their ETag lets clients revalidate them without downloading them again.
     """
+    if format not in PLOT_FORMATS:
+        raise HTTPException(status_code=400, detail="The format must be one of {}".format(list(PLOT_FORMATS)))
+    try:
+        classification_scores_dict = json.loads(classification_scores)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="The classification scores are not valid JSON")
 
-    classification_scores_dict = json.loads(classification_scores)
-    categories = [item[0] for item in classification_scores_dict]
-    values = [item[1] for item in classification_scores_dict]
-
-    # Graph creation
-    sorted_indices = sorted(range(len(values)), key=lambda k: values[k], reverse=False)
-    categories = [categories[i] for i in sorted_indices]
-    values = [values[i] for i in sorted_indices]
-    plot.figure(figsize=(10, len(categories) * 0.5))
-    plot.barh(categories, values, color=['#3F0355', '#06216C', '#795703', '#750014', '#1A4A04'])
-    plot.title('Output Scores')
-    plot.margins(y=0.01)
-    plot.tight_layout()
-    plot.grid(True, linewidth=0.1)
+    key = plot_key(classification_scores_dict, format)
+    headers = {"ETag": '"{}"'.format(key), "Cache-Control": "public, max-age={}".format(config.plot_max_age_s)}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
 
-    # Save graph as png
-    image_stream = io.BytesIO()
-    plot.savefig(image_stream, format='png')
-    image_stream.seek(0)
-    plot.close('all')
-
-    return StreamingResponse(io.BytesIO(image_stream.read()), media_type="image/png")
+    plot = plot_cache.get(key)
+    if plot is None:
+        plot = await render_pool.run(render_scores_plot, classification_scores_dict, format)
+        plot_cache.put(key, plot)
+    return Response(plot, media_type=PLOT_FORMATS[format], headers=headers)
 
 
 @app.get("/transform_image")
@@ -224,7 +455,7 @@ def transform(request: Request):
     """
     return templates.TemplateResponse(
         "transform_image.html",
-        {"request": request, "images": list_images(), "transforms": TransformWrapper().transforms},
+        {"request": request, "images": list_images(), "transforms": transform_wrapper.transforms},
     )
 
 
@@ -232,6 +463,7 @@ def transform(request: Request):
 async def transform_image(request: Request):
     """
     Handles the POST request to transform the image based on the wrapper class.
+    The page loads the transformed image from /transformed_image, so that it is cached.
     """
     form = TransformImageForm(request)
     await form.load_data()
@@ -239,22 +471,171 @@ async def transform_image(request: Request):
     transforms = form.transforms
 
     if form.is_valid():
-        # Apply transformations only if the form is valid
-        img = fetch_image(image_id)
-        img = TransformWrapper().apply_transform(img, transforms)
-
-        # Convert image to base64
-        buff = BytesIO()
-        img.save(buff, format="JPEG")
-        image_b64 = base64.b64encode(buff.getvalue())
-        image_b64 = image_b64.decode("utf-8")
+        try:
+            transforms = canonical_transforms(transforms)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        image_url = "/transformed_image/{}?{}".format(quote(image_id), urlencode(transforms))
 
         return templates.TemplateResponse(
             "transform_image_output.html",
             {
                 "request": request,
                 "image_id": image_id,
-                "image": image_b64
+                "image_url": image_url
             },
         )
 
+
+@app.get("/transformed_image/{image_id}")
+async def transformed_image(request: Request, image_id: str, format: str = "jpeg", quality: Optional[int] = None):
+    """
+    Returns a catalog image with the transformations given as query parameters (e.g. ?Contrast=1.5)
+    applied, encoded as JPEG, PNG or WebP. The results are cached by image and canonical
+    transformations, and their ETag lets clients revalidate them without downloading them again.
+    """
+    if image_id not in catalog:
+        raise HTTPException(status_code=404, detail="Unknown image id")
+    if format not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail="The format must be one of {}".format(list(IMAGE_FORMATS)))
+    if quality is None or format == "png":
+        quality = None if format == "png" else config.transform_default_quality
+    elif not 1 <= quality <= 100:
+        raise HTTPException(status_code=400, detail="The quality must be between 1 and 100")
+    params = {k: v for k, v in request.query_params.items() if k not in ("format", "quality")}
+    try:
+        transforms = canonical_transforms(params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    digest = await run_in_threadpool(catalog_image_digest, image_id)
+    key = transformed_image_key(digest, transforms, format, quality)
+    headers = {"ETag": '"{}"'.format(key), "Cache-Control": "public, max-age={}".format(config.transform_max_age_s)}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    image = transform_cache.get(key)
+    if image is None:
+        image = await render_pool.run(render_transformed_image, image_id, transforms, format, quality)
+        transform_cache.put(key, image)
+    return Response(image, media_type=IMAGE_FORMATS[format][1], headers=headers)
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Returns the metrics of the service in the Prometheus text format."""
+    if not config.metrics_enabled:
+        raise HTTPException(status_code=404, detail="The metrics are disabled")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/metrics/scheduler")
+def scheduler_metrics():
+    """Returns the queue depth, the running requests and the shed counts of the scheduler, by model."""
+    return scheduler.stats()
+
+
+def check_profiling(request: Request):
+    """Answers 404 when profiling is disabled, and 403 without the token."""
+    if not config.profiling_enabled:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    if not profiler.authorized(request.headers):
+        raise HTTPException(status_code=403, detail="The X-Profile header must carry the profiling token")
+
+
+@app.post("/admin/profiling")
+def arm_profiling(request: Request, requests: int = 1):
+    """Profiles the next requests received by the server."""
+    check_profiling(request)
+    return {"armed": profiler.arm(requests)}
+
+
+@app.get("/admin/profiling")
+def list_profiles(request: Request):
+    """Returns the number of requests still armed and the stored profile files."""
+    check_profiling(request)
+    return {"armed": profiler.armed, "profiles": profiler.store.list()}
+
+
+@app.get("/admin/profiling/{name}")
+def get_profile(request: Request, name: str):
+    """Returns a profile file: pstats statistics, or a Chrome trace (chrome://tracing, Perfetto)."""
+    check_profiling(request)
+    path = profiler.store.path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Unknown profile")
+    media_type = "application/json" if name.endswith(".json") else "application/octet-stream"
+    return FileResponse(path, media_type=media_type, filename=name)
+
+
+@app.post("/jobs/classifications")
+async def create_classification_job(request: Request):
+    """
+    Enqueues the classification of a catalog image and returns the id of the job,
+    whose result can be retrieved from /jobs/{job_id}.
+    """
+    form = ClassificationForm(request)
+    await form.load_data()
+    if not form.is_valid() or form.model_id not in registry.model_ids:
+        raise HTTPException(status_code=400, detail=form.errors or ["Unknown model id"])
+    if form.image_id not in catalog:
+        raise HTTPException(status_code=404, detail="Unknown image id")
+    job_id = await run_in_threadpool(enqueue_classification, form.model_id, form.image_id)
+    return {"job_id": job_id}
+
+
+@app.post("/jobs/classifications_upload")
+async def create_classification_upload_job(request: Request):
+    """
+    Enqueues the classification of an uploaded JPEG image and returns the id of the job,
+    whose result can be retrieved from /jobs/{job_id}.
+    """
+    form = ClassificationFormUpload(request)
+    await form.load_data()
+    if not await form.is_valid() or form.model_id not in registry.model_ids:
+        raise HTTPException(status_code=400, detail=form.errors or ["Unknown model id"])
+    form.image.close()
+    job_id = await run_in_threadpool(enqueue_upload_classification, form.model_id, form.image_data)
+    return {"job_id": job_id}
+
+
+@app.get("/jobs/{job_id}")
+async def get_classification_job(job_id: str, wait: float = 0):
+    """
+    Returns the status of a classification job and, once it is finished, its scores.
+    With wait > 0 the request is held (long-polling) until the job is finished or failed,
+    for at most wait seconds.
+    """
+    deadline = time.monotonic() + min(wait, config.job_max_wait_s)
+    while True:
+        status = await run_in_threadpool(get_job_status, job_id)
+        if status is None:
+            raise HTTPException(status_code=404, detail="Unknown job id")
+        if status["status"] in ("finished", "failed") or time.monotonic() >= deadline:
+            return status
+        await asyncio.sleep(config.job_poll_interval_s)
+
+
+@app.post("/api/classifications")
+async def api_classifications(request: Request):
+    """
+    Classifies many catalog images and/or uploaded images with many models.
+    Results are streamed as NDJSON lines, one for each (image, model) pair,
+    in the order in which they are computed. The classifications run with the
+    batch priority, and X-Timeout-Ms bounds the time allowed for each pair.
+    With "tiling": "max" or "mean", the images are classified by tiles.
+    """
+    form = BatchClassificationForm(request)
+    await form.load_data()
+    if not form.is_valid():
+        raise HTTPException(status_code=400, detail=form.errors)
+    unknown_models = [m for m in form.model_ids if m not in registry.model_ids]
+    unknown_images = [i for i in form.image_ids if i not in catalog]
+    if unknown_models or unknown_images:
+        raise HTTPException(
+            status_code=400, detail={"unknown_models": unknown_models, "unknown_images": unknown_images}
+        )
+    return StreamingResponse(
+        stream_classifications(form.image_ids + form.uploads, form.model_ids, request_timeout(request), form.tiling),
+        media_type="application/x-ndjson",
+    )
@@ -0,0 +1,91 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.executors import BoundedExecutor
+from app.metrics import model_timer
+from app.scheduler import RequestShedError, Scheduler
+
+
+def make_scheduler(limits=None, default_limit=1, half_life=30.0):
+    pool = BoundedExecutor("test", ThreadPoolExecutor(4), 100)
+    return Scheduler(pool, limits or {}, default_limit, {"interactive": 10, "batch": 10}, 1, half_life)
+
+
+def run_model(seconds):
+    with model_timer():
+        time.sleep(seconds)
+    return "model"
+
+
+def load_then_run_model(load_seconds, seconds):
+    time.sleep(load_seconds)
+    return run_model(seconds)
+
+
+def cached():
+    time.sleep(0.05)
+    return "cache"
+
+
+def failing():
+    with model_timer():
+        time.sleep(0.05)
+    raise RuntimeError("failed")
+
+
+def test_only_the_model_work_is_timed():
+    scheduler = make_scheduler()
+
+    async def scenario():
+        deadline = time.monotonic() + 10
+        await scheduler.run("m", "interactive", deadline, cached)
+        assert scheduler.stats()["models"]["m"]["service_time_s"] == 0.0
+        with pytest.raises(RuntimeError):
+            await scheduler.run("m", "interactive", deadline, failing)
+        assert scheduler.stats()["models"]["m"]["service_time_s"] == 0.0
+        await scheduler.run("m", "interactive", deadline, load_then_run_model, 0.2, 0.01)
+        assert scheduler.stats()["models"]["m"]["service_time_s"] < 0.1
+
+    asyncio.run(scenario())
+
+
+def test_estimate_decays_after_a_slow_request():
+    scheduler = make_scheduler(half_life=0.05)
+
+    async def scenario():
+        await scheduler.run("m", "interactive", time.monotonic() + 10, run_model, 0.3)
+        with pytest.raises(RequestShedError) as shed:
+            await scheduler.run("m", "interactive", time.monotonic() + 0.1, run_model, 0.01)
+        assert shed.value.status_code == 503
+        await asyncio.sleep(0.5)
+        assert await scheduler.run("m", "interactive", time.monotonic() + 0.1, run_model, 0.01) == "model"
+
+    asyncio.run(scenario())
+
+
+def test_waiting_request_cancelled_after_its_entry_is_popped():
+    scheduler = make_scheduler()
+
+    async def scenario():
+        queue = scheduler._queue("m")
+        queue.running = 1  # the slot is taken
+        waiting = asyncio.ensure_future(scheduler.run("m", "interactive", time.monotonic() + 10, run_model, 0.01))
+        await asyncio.sleep(0.01)
+        queue.waiting[0][3].cancel()
+        # the slot is released before the waiting request wakes up
+        scheduler._release("m", queue)
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert queue.running == 0 and queue.waiting == []
+
+    asyncio.run(scenario())
+
+
+def test_variants_use_the_limit_of_their_base_model():
+    scheduler = make_scheduler(limits={"vgg16": 4, "vgg16:fp16": 2}, default_limit=16)
+    assert scheduler._queue("vgg16:int8").limit == 4
+    assert scheduler._queue("vgg16:fp16").limit == 2
+    assert scheduler._queue("resnet18:int8").limit == 16